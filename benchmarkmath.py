@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# benchmarkmath.py - this is a python script to check that compilesite.py's fast path for simple math (fastmath) writes exactly what latex2mathml does,
+# and to time how much faster it is, on its own and on the table and caption rendering of a generated site
+
+# import statements
+import sys
+import os
+import json
+import random
+import subprocess
+import tempfile
+import platform
+import time
+import latex2mathml.converter
+import compilesite
+
+# grab the value given after an option like --repeat 5, or the default if it isn't there
+def optionvalue(option, default):
+    if option in sys.argv and sys.argv.index(option) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(option) + 1]
+    return default
+
+# Print usage
+if '-h' in sys.argv:
+    print("Usage: benchmarkmath.py [options]")
+    print()
+    print("Checks fastmath against latex2mathml on a corpus of formulas it should handle (and a corpus it should hand to latex2mathml), then times both.")
+    print("Exits with an error if any formula comes out different.")
+    print()
+    print("Options:")
+    print("-h: Show this (h)elp menu.")
+    print("--fuzz N: Also check N random formulas made from the pieces fastmath knows (default 5000).")
+    print("--repeat N: Convert each formula N times when timing (default 200).")
+    print("--pages N: Pages in the generated site for timing table and caption rendering (default 20, 0 skips it).")
+    print("--site-repeat N: Build the generated site N times with each converter and keep the fastest (default 3).")
+    print("--output FILE: Also write the results to FILE, as json.")
+    exit()
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+fuzzcount = int(optionvalue('--fuzz', 5000))
+repeats = max(1, int(optionvalue('--repeat', 200)))
+pages = int(optionvalue('--pages', 20))
+siterepeats = max(1, int(optionvalue('--site-repeat', 3)))
+
+# formulas fastmath has to get exactly right. Every symbol it knows, alone and between two letters, every kind of script on every kind of base,
+# and the formulas that show up on real pages (the example site and texsiteinit.py --synthetic)
+symbols = list(compilesite.fastmathsymbols.keys()) + list(compilesite.fastmathidentifiers.keys())
+conformance = [letter for letter in 'abcxyzABCXYZ'] + ['0', '7', '12', '3.5', '100.25', '2x', 'xy', ' x ', 'a b', '-1', 'x+y', 'a=b', 'f(x)', '|x|', '[a, b]']
+conformance += symbols + ['a ' + symbol + ' b' for symbol in symbols] + ['a' + symbol + 'b' for symbol in symbols if not symbol[-1].isalpha()]
+bases = ['x', 'A', '7', '10', '3.5', '\\alpha', '\\Omega']
+scripts = ['n', '1', '\\beta', '{ij}', '{i,j}', '{-1}', '{2n}', '{10}', '{a_b}', '{x^2}', '{\\mu \\nu}', ' 2', ' {2}']
+for base in bases:
+    for script in scripts:
+        conformance += [base + '_' + script, base + '^' + script, base + '_' + script + '^2', base + '^' + script + '_k', base + '_{n}^' + script]
+conformance += ['k_n', 'B_n', 'c_n', 'q_n', 'D_n', 'A_1', 'A_2', 'A_3', 'x^2', 'k_n^2', 'a^2 + b^2 = c^2', 'B_{n} = 7', 'k_{12}', 'x^{30}', 'A_{5}', '\\alpha_{3} + \\beta',
+                'e^{i \\theta_{4}}', 'x_i \\le x_{i+1}', 'p \\propto q^2', 'n \\to \\infty', 'a \\pm b', 'x \\in [0, 1]', 'r \\approx 3.14', 'n!']
+
+# formulas outside the subset, which fastmath has to leave to latex2mathml
+fallback = ['', '  ', '\\frac{1}{2}', '\\frac{a_{3}}{b}', '\\sum_{i=1}^{5} i^2', "x'", 'x_12', '1.2.3', '1.', 'x_{}', '{x}', 'x_1_2', 'x^2^3', '_1', '^2', 'x_', 'x^',
+            '\\sqrt{2}', '\\text{a}', '\\mathrm{d}x', 'a\\;b', 'x_{a', 'x}', '+^2', '\\int_0^1 x', '\\partial_t \\rho', '\\left( x \\right)', 'a \\\\ b', '\\begin{matrix} a \\end{matrix}', 'a & b', ';', '.5']
+
+failures = []
+def check(latex, expected):
+    for display in ['inline', 'block']:
+        fast = compilesite.fastmath(latex, display)
+        if expected == 'same':
+            try:
+                slow = latex2mathml.converter.convert(latex, display=display)
+            except Exception:
+                slow = None
+            if fast is None or fast != slow:
+                failures.append({'latex': latex, 'display': display, 'fastmath': fast, 'latex2mathml': slow})
+        elif fast is not None:
+            failures.append({'latex': latex, 'display': display, 'fastmath': fast, 'latex2mathml': 'should have been left to latex2mathml'})
+
+for latex in conformance:
+    check(latex, 'same')
+for latex in fallback:
+    check(latex, None)
+
+# random formulas made of pieces fastmath knows and a few it doesn't. Whenever fastmath takes one, it has to match latex2mathml
+rng = random.Random(1)
+pieces = symbols + ['x', 'y', 'k', 'N', '1', '23', '4.5', '_', '^', '{', '}', ' ', "'", '\\frac', '.']
+fuzzed = 0
+for ii in range(fuzzcount):
+    latex = ''.join([rng.choice(pieces) for jj in range(rng.randint(1, 8))])
+    if compilesite.fastmath(latex) is not None:
+        fuzzed += 1
+        check(latex, 'same')
+
+print('Conformance: {} formulas, {} fallbacks, {} of {} random formulas taken by fastmath, {} differences'.format(len(conformance), len(fallback), fuzzed, fuzzcount, len(failures)))
+for failure in failures[:20]:
+    print('  {}: {}'.format(repr(failure['latex']), failure))
+
+# time a list of formulas with both converters, per formula
+def timeconverter(converter, formulas):
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        for latex in formulas:
+            converter(latex)
+    return (time.perf_counter() - start) / (repeats * len(formulas))
+
+# what table cells and captions have in them: short formulas in the cells, a few longer ones in captions. Some captions need latex2mathml anyway
+tablecells = ['k_n', 'B_n', 'c_n', 'q_n', 'D_n', 'A_1', 'A_2', 'A_3'] + ['k_{' + str(k) + '}' for k in range(1, 31)] + ['x^{' + str(k) + '}' for k in range(1, 31)] + ['A_{' + str(k) + '}' for k in range(1, 31)]
+captions = ['k_n^2', 'x^2', '\\alpha_{3} + \\beta', 'e^{i \\theta_{4}}', 'B_{n} = 7', 'a^2 + b^2 = c^2', '\\frac{a_{3}}{b}', '\\sum_{i=1}^{5} i^2']
+results = {'python': platform.python_version(), 'latex2mathml': compilesite.metadata.version('latex2mathml'), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'conformance': {'formulas': len(conformance), 'fallbacks': len(fallback), 'fuzzed': fuzzed, 'failures': failures}, 'micro': dict(), 'site': dict()}
+for path, formulas in [['table cells', tablecells], ['captions', captions]]:
+    slow = timeconverter(lambda latex: latex2mathml.converter.convert(latex), formulas)
+    fast = timeconverter(lambda latex: compilesite.fastmath(latex) or latex2mathml.converter.convert(latex), formulas)
+    results['micro'][path] = {'formulas': len(formulas), 'latex2mathml': slow, 'fastmath': fast, 'speedup': slow / fast}
+    print('{:>12}: {:8.1f}us with latex2mathml, {:8.1f}us with fastmath, {:5.1f}x'.format(path, slow * 1e6, fast * 1e6, slow / fast))
+
+# and the same on a generated site, with the math cache off so every formula in a table or caption is converted
+if pages > 0:
+    with tempfile.TemporaryDirectory() as tempdir:
+        sitedir = os.path.join(tempdir, 'site')
+        subprocess.run([sys.executable, os.path.join(scriptdir, 'texsiteinit.py'), sitedir, '--synthetic', '--pages', str(pages), '--tables', '10', '--figures', '5'], check=True, cwd=scriptdir, stdout=subprocess.DEVNULL)
+        # one build that isn't timed first, so neither mode pays for starting the math workers. Then the modes take turns going first, and each keeps its fastest build
+        compilesite.fastmathstate['trusted'] = False
+        compilesite.Texsite(sitedir, ['-f', '--math-cache-size', '0', '--no-daemon']).build()
+        for run in range(siterepeats):
+            for mode in (['latex2mathml', 'fastmath'] if run % 2 == 0 else ['fastmath', 'latex2mathml']):
+                compilesite.fastmathstate['trusted'] = mode == 'fastmath'
+                build = compilesite.Texsite(sitedir, ['-f', '--math-cache-size', '0', '--no-daemon']).build()
+                if mode not in results['site'].keys() or build['phases']['total']['wall'] < results['site'][mode]['total']:
+                    results['site'][mode] = {phase: build['phases'][phase]['wall'] for phase in ['table/figure rendering', 'math conversion', 'render', 'total']}
+        for mode in ['latex2mathml', 'fastmath']:
+            print('{:>12}: {:.3f}s rendering tables and figures, {:.3f}s converting math, {:.3f}s total'.format(mode, results['site'][mode]['table/figure rendering'], results['site'][mode]['math conversion'], results['site'][mode]['total']))
+        compilesite.fastmathstate['trusted'] = None
+
+if '--output' in sys.argv:
+    with open(optionvalue('--output', 'benchmarkmath.json'), 'w') as file:
+        json.dump(results, file, indent=1)
+    print('Results written to {}'.format(optionvalue('--output', 'benchmarkmath.json')))
+
+if len(failures) > 0:
+    exit(1)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# benchmarksite.py - this is a python script to time compilesite.py on generated sites of different sizes, so we can see how it scales and compare versions
+
+# import statements
+import sys
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import platform
+import time
+
+# grab the value given after an option like --pages 100, or the default if it isn't there
+def optionvalue(option, default):
+    if option in sys.argv and sys.argv.index(option) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(option) + 1]
+    return default
+
+# Print usage
+if '-h' in sys.argv:
+    print("Usage: benchmarksite.py [options]")
+    print()
+    print("Generates synthetic sites with texsiteinit.py --synthetic and times each phase of compilesite.py on them, once from scratch (cold) and once more with everything cached (warm).")
+    print()
+    print("Options:")
+    print("-h: Show this (h)elp menu.")
+    print("--pages N,N,...: Site sizes to try, in pages (default 10,50,100).")
+    print("--repeat N: Build each site N times and keep the fastest (default 3).")
+    print("-j N: Passed on to compilesite.py (default 1).")
+    print("--output FILE: Where to write the results, as json (default benchmark.json).")
+    print("Anything else (--sections, --equations, --inline, --tables, --figures, --refs, --cites, --bibentries, --seed, --minify, --compress, -e) is passed on to texsiteinit.py or compilesite.py.")
+    exit()
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+pagecounts = [int(pages) for pages in optionvalue('--pages', '10,50,100').split(',')]
+repeats = max(1, int(optionvalue('--repeat', 3)))
+outputFname = optionvalue('--output', 'benchmark.json')
+
+# sort the rest of the options out to the generator and the compiler
+generatoroptions = []
+for option in ['--sections', '--equations', '--inline', '--tables', '--figures', '--refs', '--cites', '--bibentries', '--seed']:
+    if option in sys.argv:
+        generatoroptions += [option, optionvalue(option, '')]
+compileroptions = ['-j', optionvalue('-j', '1')]
+for option in ['--minify', '--compress', '-e']:
+    if option in sys.argv:
+        compileroptions.append(option)
+
+# build the site once and read back the timings. Cold builds start without the .texsite caches, warm builds keep them but force every page to render.
+# Always in a new process, never handed to a running daemon, whose caches would make a cold build warm
+def timebuild(sitedir, cold):
+    if cold:
+        shutil.rmtree(os.path.join(sitedir, '.texsite'), ignore_errors=True)
+    timingsFname = os.path.join(sitedir, 'profile.json')
+    command = [sys.executable, os.path.join(scriptdir, 'compilesite.py'), sitedir, '--profile', timingsFname, '--no-daemon'] + compileroptions
+    if not cold:
+        command.append('-f')
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(timingsFname) as file:
+        return json.load(file)
+
+results = {'python': platform.python_version(), 'platform': platform.platform(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'generator': generatoroptions, 'compiler': compileroptions, 'repeat': repeats, 'runs': []}
+with tempfile.TemporaryDirectory() as tempdir:
+    for pages in pagecounts:
+        sitedir = os.path.join(tempdir, 'site' + str(pages))
+        # texsiteinit.py copies example.png from where it is run, so run it from here
+        subprocess.run([sys.executable, os.path.join(scriptdir, 'texsiteinit.py'), sitedir, '--synthetic', '--pages', str(pages)] + generatoroptions, check=True, cwd=scriptdir)
+        for mode in ['cold', 'warm']:
+            # keep the fastest run, since that is the one with the least noise from everything else on the machine
+            best = None
+            for repeat in range(repeats):
+                timings = timebuild(sitedir, mode == 'cold')
+                if best is None or timings['phases']['total']['wall'] < best['phases']['total']['wall']:
+                    best = timings
+            results['version'] = best['version']
+            results['runs'].append({'pages': pages, 'mode': mode, 'total': best['phases']['total']['wall'], 'rendered': len(best['rendered']), 'mathcache': best['mathcache'], 'phases': best['phases']})
+            print('{} pages, {}: {:.3f}s'.format(pages, mode, best['phases']['total']['wall']))
+
+with open(outputFname, 'w') as file:
+    json.dump(results, file, indent=1)
+print('Results written to {}'.format(outputFname))
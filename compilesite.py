@@ -8,606 +8,2713 @@ import os
 import json
 from pathlib import Path
 import subprocess
-import latex2mathml.converter
+import multiprocessing
+import threading
+import time
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # not on windows, so no reflinks there
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # no .zst copies with --compress, only .gz
+try:
+    from PIL import Image
+except ImportError:
+    Image = None # no pillow, so figures get their dimensions but no downscaled variants
+try:
+    import resource
+except ImportError:
+    resource = None # not on windows, so no memory cap for the math worker there
 import shutil
-from pybtex.database import parse_file
-from pybtex.database import BibliographyData
-from pybtex import format_from_string
-
-# Print usage.
-if len(sys.argv) == 1 or '-h' in sys.argv:
-    print("Usage: compilesite.py <directory> [options]")
-    print()
-    print("Compiles the given directory into a teXsite. Options must be after the directory. Try using texsiteinit.py for creating your first directory to see the required files.")
-    print()
-    print("Options:")
-    print("-h: Show this (h)elp menu.")
-    print("-e: Put compile files in publichtml directory for easy (e)xporting.")
-    print("-v: Print the (v)ersion number.")
-    exit()
+import hashlib
+import re
+import struct
+import stat
+import gzip
+import io
+import filecmp
+import tempfile
+import sqlite3
+import mmap
+import socket
+import contextlib
+import traceback
+import csv
+import queue
+from collections import OrderedDict
+from html import unescape, escape
+from importlib import metadata
+# latex2mathml and pybtex are slow to import, so they are only imported once there is math to convert or a bibliography to format.
+# A warm build that has everything cached never imports them at all
 
 versionnumber = '0.0.3'
 
-if '-v' in sys.argv:
-    print("teXsite compiler, version {}".format(versionnumber))
-    exit()
-    
-# if here, then we should test that the given argument is a directory.
-
-rootdir = sys.argv[1]
-
-if not os.path.isdir(rootdir):
-    # not a directory
-    print("ERROR: {} is not a directory! Try compilesite.py -h for help.".format(rootdir))
-    exit()
-
-# if here, then it is a directory. check for index.txt.
-
-tocFname = os.path.join(os.getcwd(), rootdir, 'index.txt')
-
-if not os.path.exists(tocFname):
-    # not a texsite directory
-    print("ERROR: {} is not a teXsite directory! Missing required files! Try compilesite.py -h for help.".format(rootdir))
-    exit()
-    
-# make images if it doesn't exist. 
-mathdir = os.path.join(os.getcwd(),rootdir,"images")
-Path(mathdir).mkdir(parents=True, exist_ok=True)
-
-# load in index.txt toc into the compilerules dict, and pull the titles
-
-# save filenames for the export
-usedFnames = [os.path.join(os.getcwd(),rootdir,'index.html'),os.path.join(os.getcwd(),rootdir,'style.css')]
-
-titlerules = dict()
-compilerules = dict()
-sitetitle = ''
-siteauthor = ''
-backtotext = ''
-backtolink = ''
-with open(tocFname) as f:
-    for line in f:
-        # if \include is here, assign \include{key}{valcompilerules}{title}
-        # title rules maps fname (key) : valcompilerules title
-        nocommentsline = line.split('##')[0] # have to cut out commented out parts
-        if '\\include' in nocommentsline:
-            compilerules[nocommentsline.split('}{')[0].split('{')[1]] = nocommentsline.split('}{')[1]
-            titlerules[nocommentsline.split('}{')[0].split('{')[1]] = nocommentsline.split('}{')[1] + ' ' + nocommentsline.split('}{')[2].split('}')[0]
-            usedFnames.append(os.path.join(os.getcwd(), rootdir, nocommentsline.split('}{')[0].split('{')[1].split('.')[0] + '.html'))
-
-        # find title and author
-        if '\\title' in nocommentsline:
-            sitetitle = nocommentsline.split('{')[1].split('}')[0] # \title{...}
-
-        if '\\author' in nocommentsline:
-            siteauthor = nocommentsline.split('{')[1].split('}')[0] # \author{...}
-
-        # find backto
-        if '\\backto' in nocommentsline:
-            backtotext = nocommentsline.split('{')[1].split('}')[0] # \backto{backtotext}{backtolink}
-            backtolink = nocommentsline.split('}{')[1].split('}')[0]
-            
-    
-# first, run through each file and pull all the labels to make the map. Don't want more than one file open at a time. Probably not a big deal, but do it this way anyway
-
-mapping = dict()
-linkmapping = dict() # for storing the hyperlink
-tocompileFnames = list(compilerules.keys())
-substructuremap = dict() # for storing sections and subsections
-for fname in tocompileFnames:
-    # first, initialize all counting indices
-    sections = 0
-    subsections = 0
-    #subsubsections = 0 # don't want this one, too small
-    figures = 0
-    equations = 0
-    tables = 0
-    bibflag = 0
-    substructuremap[fname] = list() # to add the substructure lines to
-    with open(os.path.join(os.getcwd(), rootdir, fname)) as file:
-        for line in file:
-            # check for each thing. then pull label, determine number, add to mapping
-            nocommentsline = line.split('##')[0]
-            if '\\bibliography' in nocommentsline:
-                # treat it as a section
-                sectionname = 'References'
-                label = fname + '-references'
-                sections += 1
-                mapping[label] = compilerules[fname] + '.' + str(sections)
-                #linkmapping[label] = '/' + fname + '#' + label
-                linkmapping[label] = fname.split('.')[0] + '.html' + '#' + label
-                # start over on subsections and subsubsections
-                subsections = 0
-                subsubsections = 0
-                # add substructure line for printing on TOC
-                substructuremap[fname].append('<h3><pre>   <a href="' + linkmapping[label] + '">' + mapping[label] + ' ' + sectionname + '</a></pre></h3>')
-                
-            if '\\section' in nocommentsline:
-                # add a section
-                sectionname = nocommentsline.split('}{')[0].split('{')[1]
-                label = nocommentsline.split('}{')[1].split('}')[0] # cut out that last }
-                # increment sections
+# hash a string or a file, used by the build manifest to tell what changed since the last build
+def hashstring(string):
+    return hashlib.sha256(string.encode('utf-8')).hexdigest()
+
+def hashfile(fname):
+    hasher = hashlib.sha256()
+    with open(fname, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            hasher.update(chunk) # a chunk at a time, since data files for tables can be big
+    return hasher.hexdigest()
+
+# grab the value given after an option like -j 4, or the default if it isn't there
+def optionvalue(options, option, default):
+    if option in options and options.index(option) + 1 < len(options):
+        return options[options.index(option) + 1]
+    return default
+
+# wall and cpu clocks together, for timing the phases of a build
+def clock():
+    return (time.perf_counter(), time.process_time())
+
+# the math cache is shared by every site built in this process, since the same formulas show up over and over, across sites too. It keeps at least
+# sharedmathcachesize formulas, or more if a site asks for a bigger cache. Each site's .texsite/mathcache.json is merged in the first time the site is
+# built here, and sitemathkeys keeps which formulas each site used (mathcache.json : keys, oldest first), so a site only saves its own, up to its own cap
+sharedmathcache = OrderedDict()
+sharedmathcachesize = 50000
+sitemathkeys = dict()
+
+# most inline math is trivial, like $$k_n$$ or $$x^2$$, and doesn't need all of latex2mathml. fastmath converts a small subset by itself: letters, numbers,
+# the greek letters and operators below, and _ and ^ with a single letter, digit or greek letter, or a {group} of the same. Its output is exactly what
+# latex2mathml gives (benchmarkmath.py checks that against a corpus); anything outside the subset returns None and goes to latex2mathml
+fastmathsymbols = {'+': '<mo>&#x0002B;</mo>', '-': '<mo>&#x02212;</mo>', '=': '<mo>&#x0003D;</mo>', '<': '<mo>&#x0003C;</mo>', '>': '<mo>&#x0003E;</mo>',
+                   ',': '<mo>&#x0002C;</mo>', '/': '<mo>&#x0002F;</mo>', '*': '<mo>&#x0002A;</mo>', '!': '<mo>&#x00021;</mo>',
+                   '(': '<mo stretchy="false">&#x00028;</mo>', ')': '<mo stretchy="false">&#x00029;</mo>', '[': '<mo stretchy="false">[</mo>', ']': '<mo stretchy="false">]</mo>',
+                   '|': '<mo stretchy="false">&#x0007C;</mo>', '\\cdot': '<mo>&#x000B7;</mo>', '\\times': '<mo>&#x000D7;</mo>', '\\pm': '<mi>&#x000B1;</mi>',
+                   '\\mp': '<mo>&#x02213;</mo>', '\\le': '<mo>&#x02264;</mo>', '\\leq': '<mo>&#x02264;</mo>', '\\ge': '<mo>&#x02265;</mo>', '\\geq': '<mo>&#x02265;</mo>',
+                   '\\ne': '<mo>&#x02260;</mo>', '\\neq': '<mo>&#x02260;</mo>', '\\approx': '<mo>&#x02248;</mo>', '\\equiv': '<mo>&#x02261;</mo>',
+                   '\\propto': '<mo>&#x0221D;</mo>', '\\in': '<mo>&#x02208;</mo>', '\\to': '<mo>&#x02192;</mo>', '\\rightarrow': '<mo>&#x02192;</mo>',
+                   '\\infty': '<mo>&#x0221E;</mo>', '\\partial': '<mo>&#x02202;</mo>', '\\nabla': '<mo>&#x02207;</mo>'}
+# greek letters are identifiers, so they can have sub and superscripts
+fastmathgreek = {'alpha': '003B1', 'beta': '003B2', 'gamma': '003B3', 'delta': '003B4', 'epsilon': '003F5', 'varepsilon': '003B5', 'zeta': '003B6', 'eta': '003B7',
+                 'theta': '003B8', 'vartheta': '003D1', 'iota': '003B9', 'kappa': '003BA', 'lambda': '003BB', 'mu': '003BC', 'nu': '003BD', 'xi': '003BE',
+                 'pi': '003C0', 'varpi': '003D6', 'rho': '003C1', 'varrho': '003F1', 'sigma': '003C3', 'varsigma': '003C2', 'tau': '003C4', 'upsilon': '003C5',
+                 'phi': '003D5', 'varphi': '003C6', 'chi': '003C7', 'psi': '003C8', 'omega': '003C9', 'Gamma': '00393', 'Delta': '00394', 'Theta': '00398',
+                 'Lambda': '0039B', 'Xi': '0039E', 'Pi': '003A0', 'Sigma': '003A3', 'Upsilon': '003A5', 'Phi': '003A6', 'Psi': '003A8', 'Omega': '003A9'}
+fastmathidentifiers = {'\\' + name: '<mi>&#x' + code + ';</mi>' for name, code in fastmathgreek.items()}
+fastmathtoken = re.compile(r'\s*(?:([0-9]+(?:\.[0-9]+)?)|([A-Za-z])|(\\[A-Za-z]+)|(\S))')
+
+# the items of a row of math, up to the } that closes it if it is a group. Each item is [mathml, can have scripts, subscript, superscript].
+# Returns the row and where it ended, or None if something in it is outside the subset
+def fastmathrow(latex, pos, group):
+    items = []
+    while True:
+        match = fastmathtoken.match(latex, pos)
+        if match is None:
+            # only whitespace left
+            return None if group else (items, len(latex))
+        pos = match.end()
+        number, letter, command, other = match.groups()
+        if number is not None:
+            if latex.startswith('.', pos):
+                return None # latex2mathml splits things like 1.2.3 its own way
+            items.append(['<mn>' + number + '</mn>', True, None, None])
+        elif letter is not None:
+            items.append(['<mi>' + letter + '</mi>', True, None, None])
+        elif command in fastmathidentifiers.keys():
+            items.append([fastmathidentifiers[command], True, None, None])
+        elif command is None and other == '}':
+            return (items, pos) if group else None
+        elif command is None and other in ['_', '^']:
+            # a script goes on the item before it, once each
+            scriptslot = 2 if other == '_' else 3
+            if len(items) == 0 or not items[-1][1] or items[-1][scriptslot] is not None:
+                return None
+            match = fastmathtoken.match(latex, pos)
+            if match is None:
+                return None
+            pos = match.end()
+            number, letter, command, other = match.groups()
+            if number is not None and len(number) == 1:
+                items[-1][scriptslot] = '<mn>' + number + '</mn>'
+            elif letter is not None:
+                items[-1][scriptslot] = '<mi>' + letter + '</mi>'
+            elif command in fastmathidentifiers.keys():
+                items[-1][scriptslot] = fastmathidentifiers[command]
+            elif command is None and other == '{':
+                inner = fastmathrow(latex, pos, True)
+                if inner is None or len(inner[0]) == 0:
+                    return None
+                items[-1][scriptslot] = '<mrow>' + fastmathitems(inner[0]) + '</mrow>'
+                pos = inner[1]
+            else:
+                return None
+        elif (command if command is not None else other) in fastmathsymbols.keys():
+            items.append([fastmathsymbols[command if command is not None else other], False, None, None])
+        else:
+            return None
+
+def fastmathitems(items):
+    mathml = ''
+    for base, scriptable, subscript, superscript in items:
+        if subscript is not None and superscript is not None:
+            mathml += '<msubsup>' + base + subscript + superscript + '</msubsup>'
+        elif subscript is not None:
+            mathml += '<msub>' + base + subscript + '</msub>'
+        elif superscript is not None:
+            mathml += '<msup>' + base + superscript + '</msup>'
+        else:
+            mathml += base
+    return mathml
+
+def fastmath(latex, display='inline'):
+    row = fastmathrow(latex, 0, False)
+    if row is None or len(row[0]) == 0:
+        return None
+    return '<math xmlns="http://www.w3.org/1998/Math/MathML" display="' + display + '"><mrow>' + fastmathitems(row[0]) + '</mrow></math>'
+
+# before fastmath is trusted, it is checked once against the installed latex2mathml on a formula for each thing it handles, in case a new latex2mathml writes them differently
+fastmathprobes = ['k_n', 'A_1', 'x^2', 'x_1^2', 'x^2_1', '10^3', '3.5', '\\alpha_i + \\beta', 'x_{i,j}', 'e^{i \\pi}', 'x^{-1}', 'f(x) = |x|', '[a] \\le b \\pm 2', 'a \\cdot b \\to \\infty']
+fastmathstate = {'trusted': None}
+def fastmathtrusted():
+    if fastmathstate['trusted'] is None:
+        import latex2mathml.converter
+        fastmathstate['trusted'] = all([fastmath(probe, display) == latex2mathml.converter.convert(probe, display=display) for probe in fastmathprobes for display in ['inline', 'block']])
+    return fastmathstate['trusted']
+
+# everything fastmath doesn't handle goes to latex2mathml, in a pool of separate processes, so a formula that makes it hang, eat all the memory or crash
+# only takes one worker down. Each process that renders pages (the main one, or each one forked with -j) has its own pool, started the first time it needs it.
+# Every formula gets --math-timeout seconds, and a worker that is killed or dies is replaced by a new one
+mathpool = {'pid': None, 'replies': None, 'workers': []}
+mathpipeline = 2 # formulas sent to a worker before it answers the first, so it isn't left waiting on the pipe
+mathstartup = 60 # seconds a new worker gets to import latex2mathml, before the clock starts on its first formula
+
+def startmathworker(memory):
+    worker = {'process': subprocess.Popen([sys.executable, os.path.abspath(__file__), '--math-worker', str(memory)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1),
+              'memory': memory, 'ready': False, 'sent': [], 'started': time.perf_counter()} # sent is the formulas it hasn't answered yet, and started is when it started on the first of them
+    replies = mathpool['replies']
+    # every worker's replies are read on a thread into one queue, so waiting for the next one can time out. None means the worker is gone
+    def readreplies():
+        for line in worker['process'].stdout:
+            replies.put([worker, line])
+        replies.put([worker, None])
+    threading.Thread(target=readreplies, daemon=True).start()
+    mathpool['workers'].append(worker)
+    return worker
+
+def stopmathworker(worker):
+    worker['process'].kill()
+    worker['process'].wait()
+    mathpool['workers'].remove(worker)
+
+# convert [latex, display] formulas in the pool, with up to size workers. Returns {(latex, display): [mathml, None, False] or [None, what went wrong, transient]}.
+# Transient failures (a timeout, a worker that died or ran out of memory) might not happen again; anything else latex2mathml raises will
+def poolconvert(formulas, timeout, memory, size):
+    # a forked process inherits its parent's pool, which isn't its to use
+    if mathpool['pid'] != os.getpid():
+        mathpool.update({'pid': os.getpid(), 'replies': queue.Queue(), 'workers': []})
+    for worker in list(mathpool['workers']):
+        if worker['memory'] != memory or worker['process'].poll() is not None:
+            stopmathworker(worker)
+    results = dict()
+    pending = [tuple(formula) for formula in reversed(formulas)]
+    while len(pending) > 0 or any([len(worker['sent']) > 0 for worker in mathpool['workers']]):
+        while len(mathpool['workers']) < min(size, len(pending)):
+            startmathworker(memory)
+        for worker in list(mathpool['workers']):
+            while len(pending) > 0 and len(worker['sent']) < mathpipeline:
+                if len(worker['sent']) == 0 and worker['ready']:
+                    worker['started'] = time.perf_counter()
+                worker['sent'].append(pending.pop())
+                try:
+                    worker['process'].stdin.write(json.dumps(worker['sent'][-1]) + '\n')
+                    worker['process'].stdin.flush()
+                except OSError:
+                    break # it died, which the reader thread is about to say
+        busy = [worker for worker in mathpool['workers'] if len(worker['sent']) > 0]
+        deadlines = [worker['started'] + (timeout if worker['ready'] else max(timeout, mathstartup)) for worker in busy]
+        try:
+            worker, reply = mathpool['replies'].get(timeout=max(0.0, min(deadlines) - time.perf_counter()))
+        except queue.Empty:
+            # the worker that has been on one formula too long is killed. Whatever else it was sent goes to another worker
+            for worker, deadline in zip(busy, deadlines):
+                if deadline <= time.perf_counter():
+                    results[worker['sent'][0]] = [None, 'took longer than {} s'.format(timeout) if worker['ready'] else 'the math worker did not start', True]
+                    pending += reversed(worker['sent'][1:])
+                    stopmathworker(worker)
+            continue
+        if worker not in mathpool['workers']:
+            continue # a worker that was killed, saying it is gone
+        if reply is None:
+            results[worker['sent'][0]] = [None, 'the math worker died (out of memory?)', True]
+            pending += reversed(worker['sent'][1:])
+            stopmathworker(worker)
+            continue
+        reply = json.loads(reply)
+        if reply == 'ready':
+            worker['ready'] = True
+        else:
+            results[worker['sent'].pop(0)] = [reply.get('mathml'), reply.get('error'), reply.get('transient', False)]
+        worker['started'] = time.perf_counter()
+    return results
+
+# latex2mathml's errors often have no message, just a name
+def matherror(err):
+    return type(err).__name__ + (': ' + str(err) if str(err) != '' else '')
+
+# compilesite.py --math-worker MB is the worker: formulas come in on stdin and the mathml (or the error) goes out on stdout, one json line each
+def runmathworker(memory):
+    if resource is not None and memory > 0:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard == resource.RLIM_INFINITY or memory * 1024 * 1024 < hard:
+            resource.setrlimit(resource.RLIMIT_AS, (memory * 1024 * 1024, hard))
+    # it stops when the process that started it closes the pipe, or goes away without closing it (or on Ctrl-C, which it gets too)
+    try:
+        import latex2mathml.converter
+        sys.stdout.write(json.dumps('ready') + '\n')
+        sys.stdout.flush()
+        for line in sys.stdin:
+            latex, display = json.loads(line)
+            try:
+                reply = {'mathml': latex2mathml.converter.convert(latex, display=display)}
+            except Exception as err: # MemoryError and RecursionError included, which are what pathological formulas usually end in
+                reply = {'error': matherror(err), 'transient': isinstance(err, MemoryError)}
+            sys.stdout.write(json.dumps(reply) + '\n')
+            sys.stdout.flush()
+    except (OSError, KeyboardInterrupt):
+        pass
+
+# what goes on the page in place of a formula that couldn't be converted: its source, in red, with what went wrong when you hover over it.
+# It starts with a five letter tag like <math does, so equations can still put their id in at the same spot
+def mathplaceholder(latex, display, error):
+    return '<code style="' + ('display: block; ' if display == 'block' else '') + 'color: red" title="' + escape(error) + '">' + escape(latex) + '</code>'
+
+# errors in a page's source, like an environment that is never ended. The main script prints these and stops
+class TexsiteError(Exception):
+    pass
+
+# split a line of text into inline tokens: ('text', string), ('math', latex), ('ref', label), ('cite', [keys]).
+# text $$ math $$ text $$ math $$ text ... only counts as math if there are at least two $$. Refs and cites are only looked for outside of math
+inlinecommand = re.compile(r'\\(ref|cite)\{([^}]*)\}')
+def parseinline(text):
+    tokens = []
+    pieces = text.split('$$')
+    if len(pieces) < 3:
+        pieces = [text]
+    for ii in range(len(pieces)):
+        if ii % 2 == 1:
+            # odds are math
+            tokens.append(('math', pieces[ii]))
+            continue
+        # evens are text, look for refs and cites
+        start = 0
+        for match in inlinecommand.finditer(pieces[ii]):
+            if match.start() > start:
+                tokens.append(('text', pieces[ii][start:match.start()]))
+            if match.group(1) == 'ref':
+                tokens.append(('ref', match.group(2)))
+            else:
+                tokens.append(('cite', [key.strip() for key in match.group(2).split(',')]))
+            start = match.end()
+        if start < len(pieces[ii]):
+            tokens.append(('text', pieces[ii][start:]))
+    return tokens
+
+# pull the {first}{second} arguments out of a command line like \section{heading}{label}, erroring out if they aren't there
+def commandarguments(line, fname, linenumber):
+    if '}{' not in line or '{' not in line.split('}{')[0]:
+        raise TexsiteError('{}, line {}: expected {{...}}{{...}} after {}'.format(fname, linenumber, line.strip()))
+    return line.split('}{')[0].split('{')[1], line.split('}{')[1].split('}')[0]
+
+# the text inside the outermost braces of a line like \caption{...}. Done this way in case there are {} in the caption itself
+def bracedtext(line):
+    return '}'.join(('{'.join(line.split('{')[1:])).split('}')[:-1])
+
+# a table cell, which can be \multicolumn{columns}{text}. Returns the colspan ('' for one column) and the text
+def tablecell(tabentry, fname, linenumber):
+    if '\\multicolumn' in tabentry:
+        colspan, data = commandarguments(tabentry, fname, linenumber)
+        if not colspan.strip().isdigit():
+            raise TexsiteError('{}, line {}: expected a number of columns in {}'.format(fname, linenumber, tabentry.strip()))
+        return colspan, data
+    return '', tabentry
+
+# read the lines of an environment up to and including the line that ends it, starting after the line that begins it
+def readenvironment(numberedlines, beginline, linenumber, endcommand, fname):
+    envlines = []
+    for kk, line in numberedlines:
+        envlines.append(line.split('##')[0])
+        if endcommand in envlines[-1]:
+            return envlines
+    raise TexsiteError('{}, line {}: {} is never closed with {}'.format(fname, linenumber, beginline.strip(), endcommand))
+
+# read through a page and yield its nodes (dicts with a 'type') in the order they appear. lines can be a file, so a page never has to be in memory all at once,
+# only the environment being read. Both the label pass and the html writer walk these nodes, so nothing else has to look at the raw lines
+def iterpage(lines, fname):
+    numberedlines = enumerate(lines)
+    for kk, line in numberedlines:
+        currentline = line.split('##')[0] # split off any comments
+        linenumber = kk + 1
+        if '\\bibliography' in currentline:
+            if '\\bibliography{' not in currentline or '}{' not in currentline.split('\\bibliography{')[1]:
+                raise TexsiteError('{}, line {}: expected \\bibliography{{file.bib}}{{style}}'.format(fname, linenumber))
+            bibargs = currentline.split('\\bibliography{')[1]
+            yield {'type': 'bibliography', 'line': linenumber, 'file': bibargs.split('}{')[0], 'style': bibargs.split('}{')[1].split('}')[0]}
+
+        elif '\\section' in currentline or '\\subsection' in currentline:
+            heading, label = commandarguments(currentline, fname, linenumber)
+            nodetype = 'subsection' if '\\subsection' in currentline else 'section'
+            yield {'type': nodetype, 'line': linenumber, 'heading': heading, 'label': label, 'tokens': parseinline(heading)}
+
+        elif '\\begin{equation}' in currentline:
+            label = commandarguments(currentline, fname, linenumber)[1]
+            # keep the body lines and the end line, the equation number gets put in when the page is written
+            yield {'type': 'equation', 'line': linenumber, 'label': label, 'begin': currentline.split('}')[0] + '}\n', 'body': readenvironment(numberedlines, currentline, linenumber, '\\end{equation}', fname)}
+
+        elif '\\begin{equation*}' in currentline:
+            yield {'type': 'equation*', 'line': linenumber, 'begin': currentline, 'body': readenvironment(numberedlines, currentline, linenumber, '\\end{equation*}', fname)}
+
+        elif '\\begin{figure}' in currentline:
+            envlines = readenvironment(numberedlines, currentline, linenumber, '\\end{figure}', fname)
+            label = commandarguments(currentline, fname, linenumber)[1]
+            graphicsline = ''
+            graphicsnumber = linenumber
+            captionline = ''
+            for rownumber, ln in enumerate(envlines[:-1]):
+                if '\\includegraphics' in ln:
+                    graphicsline = ln
+                    graphicsnumber = linenumber + 1 + rownumber
+                elif '\\caption' in ln:
+                    captionline = ln
+            if '{' not in graphicsline:
+                raise TexsiteError('{}, line {}: figure {} has no \\includegraphics{{...}}'.format(fname, linenumber, label))
+            scale = 1.0
+            if '}{' in graphicsline:
+                # we have some scaling to deal with, a fraction of the page width
+                try:
+                    scale = float(graphicsline.split('}{')[1].split('}')[0])
+                except ValueError:
+                    scale = float('nan')
+                if not 0 < scale < float('inf'):
+                    raise TexsiteError('{}, line {}: expected a positive number for the scale in {}'.format(fname, graphicsnumber, graphicsline.strip()))
+            caption = bracedtext(captionline)
+            yield {'type': 'figure', 'line': linenumber, 'label': label, 'file': graphicsline.split('}')[0].split('{')[1], 'scale': scale, 'caption': caption, 'tokens': parseinline(caption)}
+
+        elif '\\begin{table}' in currentline:
+            envlines = readenvironment(numberedlines, currentline, linenumber, '\\end{table}', fname)
+            label = commandarguments(currentline, fname, linenumber)[1]
+            # every line is a row, except the caption and \includedata{file.csv}, which adds the rows of a csv or tsv file after them
+            rows = []
+            caption = ''
+            dataFname = ''
+            for rownumber, ln in enumerate(envlines[:-1]):
+                if '\\caption' in ln:
+                    caption = bracedtext(ln)
+                    continue
+                if '\\includedata' in ln:
+                    dataFname = bracedtext(ln).strip()
+                    continue
+                row = []
+                for tabentry in ln.split('&'):
+                    # figure out if we take up more than one column
+                    colspan, data = tablecell(tabentry, fname, linenumber + 1 + rownumber)
+                    row.append({'colspan': colspan, 'tokens': parseinline(data)})
+                rows.append(row)
+            yield {'type': 'table', 'line': linenumber, 'label': label, 'rows': rows, 'data': dataFname, 'caption': caption, 'tokens': parseinline(caption)}
+
+        elif currentline.strip() == '\\nodefermath':
+            # this page keeps all its math in place, even with --defer-math
+            yield {'type': 'nodefermath', 'line': linenumber}
+
+        else:
+            # everything else is a paragraph
+            yield {'type': 'paragraph', 'line': linenumber, 'tokens': parseinline(currentline)}
+
+# the whole document tree of a page, as a list
+def parsepage(lines, fname):
+    return list(iterpage(lines, fname))
+
+# all the inline tokens in a node, wherever they are in it
+def nodetokens(node):
+    tokens = list(node.get('tokens', []))
+    for row in node.get('rows', []):
+        for cell in row:
+            tokens += cell['tokens']
+    return tokens
+
+# figures. Each image gets its width and height written out so pages don't reflow, and with pillow, downscaled copies for srcset
+variantwidths = [320, 640, 960, 1280, 1920] # widths of the downscaled copies
+foldcharacters = 1500 # roughly how much text fits on the first screen. Figures after that get loading="lazy"
+
+# read width and height from the image header without decoding the image. png, gif and jpeg are done by hand, anything else needs pillow
+def imagedimensions(path):
+    with open(path, 'rb') as file:
+        head = file.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return list(struct.unpack('>II', head[16:24]))
+        if head[:6] in [b'GIF87a', b'GIF89a']:
+            return list(struct.unpack('<HH', head[6:10]))
+        if head[:2] == b'\xff\xd8':
+            # walk the jpeg segments until the start of frame, which has the size
+            file.seek(2)
+            while True:
+                marker = file.read(2)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    break
+                if marker[1] == 0xff:
+                    file.seek(-1, 1) # padding
+                    continue
+                length = struct.unpack('>H', file.read(2))[0]
+                if 0xc0 <= marker[1] <= 0xcf and marker[1] not in [0xc4, 0xc8, 0xcc]:
+                    height, width = struct.unpack('>HH', file.read(5)[1:5])
+                    return [width, height]
+                file.seek(length - 2, 1)
+    if Image is not None:
+        try:
+            with Image.open(path) as image:
+                return list(image.size)
+        except OSError:
+            pass
+    return None
+
+# widths of the downscaled copies for an image. Only smaller than the original, and only for formats pillow can resize without losing anything (no animated gifs)
+def imagevariants(figureFname, imageinfo):
+    info = imageinfo.get(figureFname)
+    if Image is None or info is None or info['width'] is None or os.path.splitext(figureFname)[1].lower() not in ['.png', '.jpg', '.jpeg', '.webp']:
+        return []
+    return [width for width in variantwidths if width < info['width']]
+
+# copies are named by the content hash of the original, so a changed image gets new copies and an unchanged one never needs them made again
+def variantname(figureFname, width, imageinfo):
+    stem, extension = os.path.splitext(figureFname)
+    return 'variants/' + stem + '-' + imageinfo[figureFname]['hash'][:12] + '-' + str(width) + 'w' + extension
+
+# with --fingerprint, images are published as images/hashed/<name>-<hash>.<extension>, so a name always means the same bytes and CDNs can cache it forever
+def fingerprintname(figureFname, imageinfo):
+    stem, extension = os.path.splitext(figureFname)
+    return 'hashed/' + stem + '-' + imageinfo[figureFname]['hash'][:12] + extension
+
+def makevariant(variant):
+    source, target, width = variant
+    with Image.open(source) as image:
+        imageformat = image.format
+        resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+    # write it under another name first, so an interrupted build never leaves a half-written copy that looks cached
+    resized.save(target + '.part', format=imageformat)
+    os.replace(target + '.part', target)
+
+# rough guess at how much of the screen a node takes up, in characters of text. Only used to find the figures below the fold
+def nodeheight(node):
+    if node['type'] == 'nodefermath':
+        return 0
+    if node['type'] in ['figure', 'table']:
+        return foldcharacters
+    if node['type'] in ['equation', 'equation*']:
+        return 300
+    return 80 + sum([len(value) for kind, value in node.get('tokens', []) if kind in ['text', 'math']])
+
+# --defer-math N keeps the first N characters of each page (see nodeheight) as they are, and puts the rest in chunks of a section or subsection each:
+# <section class=texsite-deferred>, with every formula in it as a placeholder with its source, and the mathml for all of them in a <template> at the end, which
+# the browser doesn't lay out. This script swaps the mathml in when a chunk is about to scroll into view, or right away when a link points into it,
+# then jumps to the link again, since the page above it has changed. Without javascript, the placeholders (the latex) are what is shown
+deferscript = r'''<script>
+(function() {
+    var chunks = document.querySelectorAll('section.texsite-deferred');
+    function activate(chunk) {
+        var template = chunk.querySelector('template');
+        if (template === null) return;
+        var placeholders = chunk.querySelectorAll('code.texsite-math');
+        var maths = Array.prototype.slice.call(template.content.children);
+        for (var i = 0; i < placeholders.length && i < maths.length; i++) placeholders[i].parentNode.replaceChild(maths[i], placeholders[i]);
+        template.parentNode.removeChild(template);
+    }
+    function reveal() {
+        var id = decodeURIComponent(location.hash.slice(1));
+        var target = id === '' ? null : document.getElementById(id);
+        for (var i = 0; target !== null && i < chunks.length; i++) {
+            if (chunks[i].contains(target)) {
+                activate(chunks[i]);
+                document.getElementById(id).scrollIntoView();
+            }
+        }
+    }
+    if ('IntersectionObserver' in window) {
+        var observer = new IntersectionObserver(function(entries) {
+            entries.forEach(function(entry) {
+                if (entry.isIntersecting) {
+                    observer.unobserve(entry.target);
+                    activate(entry.target);
+                }
+            });
+        }, {rootMargin: '1000px 0px'});
+        for (var i = 0; i < chunks.length; i++) observer.observe(chunks[i]);
+    } else {
+        for (var i = 0; i < chunks.length; i++) activate(chunks[i]);
+    }
+    reveal();
+    window.addEventListener('hashchange', reveal);
+})();
+</script>'''
+
+# --toc-chapters puts each chapter's sections on index.html in a <details>, and this script fills it in from toc/(page).html the first time it is opened.
+# Without javascript, the link to the chapter is still there
+tocscript = r'''<script>
+document.querySelectorAll('details[data-toc]').forEach(function(details) {
+    details.addEventListener('toggle', function() {
+        if (!details.open || details.dataset.loaded) return;
+        details.dataset.loaded = 'yes';
+        fetch(details.dataset.toc).then(function(response) { return response.ok ? response.text() : ''; }).then(function(html) {
+            details.insertAdjacentHTML('beforeend', html);
+        });
+    });
+});
+</script>'''
+
+# options that change what a page looks like, so pages are rebuilt when they are turned on or off
+renderoptions = ['--minify', '--fingerprint']
+
+# output. With --minify, html and css are minified before writing, and files are only written if their contents changed, so unchanged output keeps its mtime
+htmltag = re.compile(r'(<[^>]*>)')
+mspacerun = re.compile(r'(?:<mspace width="[0-9.]+em" ?/>){2,}')
+preservetags = ['pre', 'textarea', 'script', 'style', 'mi', 'mn', 'mo', 'ms', 'mtext'] # whitespace inside these is kept exactly
+blocktags = ['html', 'head', 'title', 'link', 'meta', 'body', 'div', 'section', 'template', 'noscript', 'details', 'summary', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'figure', 'figcaption', 'table', 'tr', 'th', 'td', 'ol', 'ul', 'li', 'pre', 'script'] # and <math display="block">, but not inline math, which sits in the text
+
+def tagname(tag):
+    return tag.strip('</>').split()[0].lower() if tag.strip('</>').strip() != '' else ''
+
+# the \; padding around equation numbers turns into long runs of <mspace>, which can be one <mspace> of the same total width
+def mergemspaces(match):
+    width = sum([float(value) for value in re.findall(r'width="([0-9.]+)em"', match.group(0))])
+    return '<mspace width="' + ('%.3f' % width).rstrip('0').rstrip('.') + 'em"/>'
+
+def minifyhtml(html):
+    pieces = htmltag.split(mspacerun.sub(mergemspaces, html)) # text, tag, text, tag, ..., text
+    preserving = 0 # how many preserve tags we are inside
+    mathdepth = 0
+    # which tags are block tags. A </math> is one if its <math> was
+    isblock = [False] * len(pieces)
+    mathblocks = []
+    for ii in range(1, len(pieces), 2):
+        name = tagname(pieces[ii])
+        if name == 'math' and not pieces[ii].endswith('/>'):
+            if pieces[ii].startswith('</'):
+                isblock[ii] = len(mathblocks) > 0 and mathblocks.pop()
+            else:
+                mathblocks.append('display="block"' in pieces[ii])
+                isblock[ii] = mathblocks[-1]
+        else:
+            isblock[ii] = name in blocktags
+    for ii in range(len(pieces)):
+        if ii % 2 == 1:
+            # a tag. Keep count of where we are, and tidy up self closing tags
+            name = tagname(pieces[ii])
+            if not pieces[ii].endswith('/>'):
+                change = -1 if pieces[ii].startswith('</') else 1
+                if name in preservetags:
+                    preserving += change
+                if name == 'math':
+                    mathdepth += change
+            pieces[ii] = re.sub(r'\s+/>$', '/>', pieces[ii])
+        elif preserving <= 0:
+            # text. Collapse whitespace, and drop it where it can't show, next to block tags and between math elements
+            text = re.sub(r'\s+', ' ', pieces[ii])
+            if mathdepth > 0 and text == ' ':
+                text = ''
+            if ii > 0 and isblock[ii-1]:
+                text = text.lstrip(' ')
+            if ii + 1 < len(pieces) and isblock[ii+1]:
+                text = text.rstrip(' ')
+            pieces[ii] = text
+    return ''.join(pieces)
+
+def minifycss(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+def writeoutput(path, text, minify):
+    if minify:
+        text = minifycss(text) if path.endswith('.css') else minifyhtml(text)
+    if os.path.exists(path):
+        with open(path) as file:
+            if file.read() == text:
+                return False
+    with open(path, 'w') as file:
+        file.write(text)
+    return True
+
+# streamed pages are written to path.part as they are rendered. Like writeoutput, the old file (and its mtime) is kept if nothing changed
+def finishoutput(path):
+    if os.path.exists(path) and filecmp.cmp(path, path + '.part', shallow=False):
+        os.remove(path + '.part')
+        return False
+    os.replace(path + '.part', path)
+    return True
+
+# --compress writes these next to every html and css file. They copy from one open file to another a chunk at a time, so big pages are never read in whole
+def gzipcopy(source, target):
+    with gzip.GzipFile(filename='', fileobj=target, mode='wb', compresslevel=9, mtime=0) as gzipfile:
+        shutil.copyfileobj(source, gzipfile)
+
+compressors = {'.gz': gzipcopy}
+if zstandard is not None:
+    compressors['.zst'] = lambda source, target: zstandard.ZstdCompressor(level=19).copy_stream(source, target, size=os.fstat(source.fileno()).st_size)
+
+# the compressed copies get the same mtime as the file they came from, so if the file wasn't rewritten, they are still good
+def compressoutput(path):
+    pathstat = os.stat(path)
+    for extension in compressors.keys():
+        if os.path.exists(path + extension) and os.stat(path + extension).st_mtime_ns == pathstat.st_mtime_ns:
+            continue
+        with open(path, 'rb') as source, open(path + extension + '.part', 'wb') as target:
+            compressors[extension](source, target)
+        os.utime(path + extension + '.part', ns=(pathstat.st_atime_ns, pathstat.st_mtime_ns))
+        os.replace(path + extension + '.part', path + extension)
+
+# whether path is one of the files in Fnames (a set), or the --compress copy of one, so cleaning up a directory of output leaves both alone
+def listedoutput(path, Fnames):
+    return path in Fnames or (os.path.splitext(path)[1] in compressors.keys() and os.path.splitext(path)[0] in Fnames)
+
+# copy-on-write clone of a file where the filesystem can do it (btrfs, xfs), otherwise a normal copy. Either way, the mtime comes along
+def clonefile(source, target):
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as sourcefile, open(target, 'wb') as targetfile:
+                fcntl.ioctl(targetfile.fileno(), 0x40049409, sourcefile.fileno()) # FICLONE
+            shutil.copystat(source, target)
+            return
+        except OSError:
+            pass # not supported here, fall back to copying
+    shutil.copy2(source, target)
+
+# whether target is a copy of what source has now. Copies keep the mtime, so the hash is only needed when that differs. A hardlink to source isn't a copy:
+# it changes whenever source is edited in place
+def unchangedfile(source, target):
+    if os.path.samefile(source, target):
+        return False
+    sourcestat = os.stat(source)
+    targetstat = os.stat(target)
+    return sourcestat.st_size == targetstat.st_size and (sourcestat.st_mtime_ns == targetstat.st_mtime_ns or hashfile(source) == hashfile(target))
+
+# make target match source. Returns True if anything had to be written. Only files that are meant to follow source, like the fingerprinted names
+# of images in the site directory, can be hardlinked. Anything published gets its own copy (a clone where the filesystem can), since images are
+# edited in place and publichtml shouldn't change until the next export
+def syncfile(source, target, allowlink):
+    if os.path.exists(target):
+        if allowlink and os.path.samefile(source, target):
+            return False # already hardlinked
+        if unchangedfile(source, target):
+            return False
+        os.remove(target) # never write through an old hardlink
+    if allowlink:
+        try:
+            os.link(source, target)
+            return True
+        except OSError:
+            pass # different filesystem, or links not allowed
+    clonefile(source, target)
+    return True
+
+# with --atomic, -e never touches the published site while it is being served. publichtml is a symlink to a generation, publichtml-generations/N,
+# and each export puts a whole new generation together next to it, then switches the symlink over with a rename, which readers see all at once.
+# Generations are never written to after that, so a file that didn't change is hardlinked from the one before instead of copied, and the one
+# before is kept for --rollback. Files only ever come from the site directory as copies, never links, so editing an image there can't change a generation
+def stagefile(source, target, previous):
+    if os.path.exists(previous) and unchangedfile(source, previous):
+        try:
+            os.link(previous, target)
+            return False
+        except OSError:
+            pass # links not allowed, so it has to be copied after all
+    return syncfile(source, target, False)
+
+# the generations there are, newest last
+def generations(publichtmldir):
+    generationsdir = publichtmldir + '-generations'
+    if not os.path.isdir(generationsdir):
+        return []
+    return [os.path.join(generationsdir, name) for name in sorted([name for name in os.listdir(generationsdir) if name.isdigit()], key=int)]
+
+# point publichtml at a generation. The new symlink is made next to it and renamed over it, so there is no moment without a publichtml
+def publishgeneration(publichtmldir, generationdir):
+    linkFname = publichtmldir + '.new'
+    if os.path.lexists(linkFname):
+        os.remove(linkFname)
+    os.symlink(os.path.relpath(generationdir, os.path.dirname(publichtmldir)), linkFname)
+    os.replace(linkFname, publichtmldir)
+
+# go back to the generation before the one being served
+def rollbackgeneration(publichtmldir):
+    if not os.path.islink(publichtmldir):
+        raise TexsiteError('{} is not a generation from -e --atomic, so there is nothing to roll back to'.format(publichtmldir))
+    current = os.path.realpath(publichtmldir)
+    older = [generationdir for generationdir in generations(publichtmldir) if os.path.realpath(generationdir) != current and int(os.path.basename(generationdir)) < int(os.path.basename(current))]
+    if len(older) == 0:
+        raise TexsiteError('there is no generation before {} to roll back to'.format(current))
+    publishgeneration(publichtmldir, older[-1])
+    return older[-1]
+
+# --fingerprint also writes _headers, the cache headers for every published file in the format Netlify and Cloudflare Pages read.
+# Fingerprinted files never change, so they can be cached for a year; everything else keeps its name across deploys, so it only gets a few minutes
+immutablecache = 'public, max-age=31536000, immutable'
+shortcache = 'public, max-age=300, must-revalidate'
+
+# the label index, .texsite/labels.sqlite, has every label on the site (its number, the page it is on and its link) and each page's toc lines.
+# It is updated a page at a time as pages change, and lets --page look up just the labels one page refers to, without reading the rest of the site
+def openlabelindex(cachedir):
+    Path(cachedir).mkdir(parents=True, exist_ok=True)
+    labelindex = sqlite3.connect(os.path.join(cachedir, 'labels.sqlite'))
+    # labels used to only keep their anchor, which isn't enough once pages can be split into several files. Start that kind of index over
+    if 'anchor' in [column[1] for column in labelindex.execute('PRAGMA table_info(labels)').fetchall()]:
+        labelindex.execute('DROP TABLE labels')
+        labelindex.execute('DROP TABLE IF EXISTS pages')
+    labelindex.execute('CREATE TABLE IF NOT EXISTS labels (label TEXT PRIMARY KEY, number TEXT, page TEXT, link TEXT)')
+    labelindex.execute('CREATE INDEX IF NOT EXISTS labelsbypage ON labels (page)')
+    labelindex.execute('CREATE TABLE IF NOT EXISTS pages (page TEXT PRIMARY KEY, key TEXT, substructure TEXT)')
+    return labelindex
+
+# key is whatever the labels depend on (compiler version, chapter number, page hash and whether it is split), so a page is only written again when it changes
+def updatelabelindex(labelindex, fname, key, labels, substructure):
+    row = labelindex.execute('SELECT key FROM pages WHERE page = ?', (fname,)).fetchone()
+    if row is not None and row[0] == key:
+        return False
+    labelindex.execute('DELETE FROM labels WHERE page = ?', (fname,))
+    labelindex.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)', [(label, labels[label][0], fname, labels[label][1]) for label in labels.keys()])
+    labelindex.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (fname, key, json.dumps(substructure)))
+    return True
+
+# label : [number, link] for the labels that are in the index. Done in batches, since sqlite only takes so many ? at once
+def lookuplabels(labelindex, labels):
+    found = dict()
+    labels = list(labels)
+    for ii in range(0, len(labels), 500):
+        batch = labels[ii:ii+500]
+        for label, number, link in labelindex.execute('SELECT label, number, link FROM labels WHERE label IN (' + ', '.join(['?'] * len(batch)) + ')', batch):
+            found[label] = [number, link]
+    return found
+
+# the bib index, .texsite/bibindex.sqlite, has where each entry of each version of a bib file starts and ends and which entry it crossrefs, plus where its @strings are.
+# A bib file is scanned once when it changes, and after that citing a few articles from a big shared library only reads and parses those few entries
+bibcommand = re.compile(rb'@\s*(\w+)\s*([{(])')
+bibtoken = re.compile(rb'[{}()"]')
+bibcrossref = re.compile(rb'\bcrossref\s*=\s*[{"]\s*([^\s{}",]+)', re.IGNORECASE)
+
+def openbibindex(cachedir):
+    Path(cachedir).mkdir(parents=True, exist_ok=True)
+    bibindex = sqlite3.connect(os.path.join(cachedir, 'bibindex.sqlite'))
+    bibindex.execute('CREATE TABLE IF NOT EXISTS bibfiles (hash TEXT PRIMARY KEY)')
+    bibindex.execute('CREATE TABLE IF NOT EXISTS entries (hash TEXT, key TEXT, start INTEGER, length INTEGER, crossref TEXT, PRIMARY KEY (hash, key))')
+    bibindex.execute('CREATE TABLE IF NOT EXISTS strings (hash TEXT, start INTEGER, length INTEGER)')
+    bibindex.execute('CREATE INDEX IF NOT EXISTS stringsbyhash ON strings (hash)')
+    return bibindex
+
+# find where every @entry, @string and @preamble in a bib file ends, the way pybtex reads them: braces have to balance, and a ( entry ends at the first ) outside
+# braces and quotes. @comment is skipped up to its opening brace, like pybtex does. The file is mapped rather than read, so even a huge one isn't loaded all at once
+def indexbibfile(bibindex, bibhash, bibfname):
+    if bibindex.execute('SELECT hash FROM bibfiles WHERE hash = ?', (bibhash,)).fetchone() is not None:
+        return False
+    entries = []
+    strings = []
+    with open(bibfname, 'rb') as file:
+        if os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                pos = 0
+                while True:
+                    match = bibcommand.search(data, pos)
+                    if match is None:
+                        break
+                    command = match.group(1).lower()
+                    if command == b'comment':
+                        pos = match.end()
+                        continue
+                    end = None
+                    depth = 0
+                    quoted = False
+                    for token in bibtoken.finditer(data, match.end()):
+                        char = token.group()
+                        if char == b'{':
+                            depth += 1
+                        elif char == b'}' and depth > 0:
+                            depth -= 1
+                        elif char == b'}' and match.group(2) == b'{':
+                            end = token.end()
+                            break
+                        elif char == b'"' and depth == 0:
+                            quoted = not quoted
+                        elif char == b')' and depth == 0 and not quoted and match.group(2) == b'(':
+                            end = token.end()
+                            break
+                    if end is None:
+                        break # never closed, so pybtex couldn't read it either
+                    if command == b'string':
+                        strings.append((bibhash, match.start(), end - match.start()))
+                    elif command != b'preamble':
+                        body = data[match.end():end]
+                        key = body.split(b',')[0].strip().decode('utf-8', 'replace').lower()
+                        crossref = bibcrossref.search(body)
+                        entries.append((bibhash, key, match.start(), end - match.start(), crossref.group(1).decode('utf-8', 'replace').lower() if crossref is not None else ''))
+                    pos = end
+    # a key that is in the file twice keeps its first entry, like pybtex does when it isn't strict
+    bibindex.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)', entries)
+    bibindex.executemany('INSERT INTO strings VALUES (?, ?, ?)', strings)
+    bibindex.execute('INSERT INTO bibfiles VALUES (?)', (bibhash,))
+    bibindex.commit()
+    return True
+
+# the keys of a bib file that are in it, out of the ones asked for. Done in batches, like lookuplabels
+def lookupbibkeys(bibindex, bibhash, keys):
+    found = dict() # key : [start, length, crossref]
+    keys = list(keys)
+    for ii in range(0, len(keys), 500):
+        batch = keys[ii:ii+500]
+        for key, start, length, crossref in bibindex.execute('SELECT key, start, length, crossref FROM entries WHERE hash = ? AND key IN (' + ', '.join(['?'] * len(batch)) + ')', [bibhash] + batch):
+            found[key] = [start, length, crossref]
+    return found
+
+# parse just the entries for some keys out of a bib file, along with the entries they crossref (pybtex needs those to fill in missing fields) and every
+# @string, since any entry could use them. They are read in the order they are in the file, so @strings come before the entries that use them
+def readbibentries(bibindex, bibhash, bibfname, keys):
+    from pybtex.database import parse_string
+    found = lookupbibkeys(bibindex, bibhash, keys)
+    crossrefs = set([found[key][2] for key in found.keys() if found[key][2] != '']) - set(found.keys())
+    while len(crossrefs) > 0:
+        parents = lookupbibkeys(bibindex, bibhash, crossrefs)
+        found.update(parents)
+        crossrefs = set([parents[key][2] for key in parents.keys() if parents[key][2] != '']) - set(found.keys())
+    pieces = sorted(bibindex.execute('SELECT start, length FROM strings WHERE hash = ?', (bibhash,)).fetchall()) + sorted([(start, length) for start, length, crossref in found.values()])
+    chunks = []
+    with open(bibfname, 'rb') as file:
+        for start, length in pieces:
+            file.seek(start)
+            chunks.append(file.read(length))
+    return parse_string(b'\n'.join(chunks).decode('utf-8'), 'bibtex')
+
+# forget the versions of bib files no page uses anymore
+def prunebibindex(bibindex, bibhashes):
+    for (bibhash,) in bibindex.execute('SELECT hash FROM bibfiles').fetchall():
+        if bibhash not in bibhashes:
+            bibindex.execute('DELETE FROM entries WHERE hash = ?', (bibhash,))
+            bibindex.execute('DELETE FROM strings WHERE hash = ?', (bibhash,))
+            bibindex.execute('DELETE FROM bibfiles WHERE hash = ?', (bibhash,))
+    bibindex.commit()
+
+# --search. Every page is split into documents (the top of the page, each section and subsection, each figure and table, and the references), and words
+# are runs of letters and digits, lowercased, at least two long. A word in a heading counts for more than one in a caption, which counts for more than one in the text
+searchword = re.compile(r'[^\W_]{2,}')
+headingweight = 5
+captionweight = 2
+
+# the text of some html, without tags or entities
+def plaintext(html):
+    return unescape(htmltag.sub('', html))
+
+# the text of a list of inline tokens. Math, refs and cites aren't words, so they are left out
+def tokentext(tokens):
+    return ' '.join(plaintext(''.join([value for kind, value in tokens if kind == 'text'])).split())
+
+# add the words in text to a document of the page being indexed
+def addsearchtext(searchpage, doc, text, weight):
+    for word in searchword.findall(text.lower()):
+        if word not in searchpage['terms'].keys():
+            searchpage['terms'][word] = dict()
+        searchpage['terms'][word][doc] = searchpage['terms'][word].get(doc, 0) + weight
+
+# the index is sharded by the first two letters of each word, search/<letters>.json, so the browser only fetches the shards for the words it is looking for.
+# search/docs.json has the link and title of every document
+def searchshard(word):
+    return word[:2]
+
+# search.html loads the shards for the words typed in and ranks the documents that have all of them. The last word can still be being typed, so it matches any word it starts
+searchscript = r'''<script>
+var shards = {};
+var docs = null;
+var searches = 0;
+function fetchjson(url) {
+    return fetch(url).then(function(response) { return response.ok ? response.json() : {}; });
+}
+function shard(word) {
+    var letters = Array.from(word).slice(0, 2).join('');
+    if (!(letters in shards)) shards[letters] = fetchjson('search/' + encodeURIComponent(letters) + '.json');
+    return shards[letters];
+}
+function search(query) {
+    var search = ++searches;
+    var words = query.toLowerCase().match(/[\p{L}\p{N}]{2,}/gu) || [];
+    if (docs === null) docs = fetchjson('search/docs.json');
+    Promise.all([docs].concat(words.map(shard))).then(function(loaded) {
+        if (search != searches) return;
+        var scores = null;
+        words.forEach(function(word, ii) {
+            var found = {};
+            for (var key in loaded[ii + 1]) {
+                if (key == word || (ii == words.length - 1 && key.startsWith(word))) {
+                    loaded[ii + 1][key].forEach(function(posting) { found[posting[0] + ' ' + posting[1]] = (found[posting[0] + ' ' + posting[1]] || 0) + posting[2]; });
+                }
+            }
+            if (scores === null) {
+                scores = found;
+            } else {
+                for (var doc in scores) {
+                    if (doc in found) scores[doc] += found[doc]; else delete scores[doc];
+                }
+            }
+        });
+        var results = document.getElementById('results');
+        results.replaceChildren();
+        Object.keys(scores || {}).sort(function(a, b) { return scores[b] - scores[a]; }).slice(0, 50).forEach(function(doc) {
+            var page = loaded[0][doc.split(' ')[0]];
+            var entry = page.docs[Number(doc.split(' ')[1])];
+            var line = document.createElement('p');
+            var link = document.createElement('a');
+            link.href = entry[0];
+            link.textContent = entry[1];
+            line.appendChild(link);
+            if (entry[1] != page.title) line.appendChild(document.createTextNode(' (' + page.title + ')'));
+            results.appendChild(line);
+        });
+    });
+}
+</script>'''
+
+# a teXsite directory, and everything known about it while it is being built. options are the same as on the command line, like ['-j', '4', '--minify'].
+# build() returns what happened instead of printing it, and everything about the site lives on the object. Two things are deliberately shared by every
+# Texsite in a process: the math cache (sharedmathcache, with sitemathkeys saying which formulas are whose) and the math worker pool (mathpool).
+# forkedsite only hands the site to the -j workers. Sites in one process can be built one after another, and buildsites builds them side by side
+# in forked processes, which is where their isolation from each other comes from
+class Texsite:
+    def __init__(self, rootdir, options=[]):
+        self.rootdir = rootdir
+        self.options = list(options)
+        if not os.path.isdir(rootdir):
+            raise TexsiteError('{} is not a directory! Try compilesite.py -h for help.'.format(rootdir))
+        self.tocFname = os.path.join(os.getcwd(), rootdir, 'index.txt')
+        if not os.path.exists(self.tocFname):
+            raise TexsiteError('{} is not a teXsite directory! Missing required files! Try compilesite.py -h for help.'.format(rootdir))
+        self.mathcache = sharedmathcache
+        self.mathcachestats = {'hits': 0, 'misses': 0, 'fast': 0} # fast counts the misses fastmath converted
+        self.mathcachenew = dict() # formulas used since the last page started, so worker processes can hand them back
+        self.mathcachesize = 50000
+        self.mathkeys = OrderedDict() # the formulas this site uses, see sitemathkeys
+        self.mathtimeout = 10.0
+        self.mathmemory = 1024
+        self.mathfailures = dict() # math cache key : error, for formulas that timed out or took their worker down, kept for as long as this Texsite is
+        self.matherrors = [] # where they were
+        self.mathsource = ['', '', 0] # the page being rendered, and the file and line the math being converted is from
+        self.mathworkers = 1
+        self.mathprefetched = dict() # (latex, display) : [mathml, error, transient], for the math of the page being rendered (see prefetchmath)
+        self.phasetimes = dict()
+        self.pagetrees = dict()
+        self.pagelinecounts = dict()
+        self.pageparts = dict()
+        self.pagedefermath = dict()
+        self.mathfold = None
+        self.deferredmath = None # the mathml saved for the deferred chunk being written
+        self.datahashes = dict()
+        self.latex2mathmlversion = ''
+        self.stylesheet = 'style.css'
+        self.imageinfo = dict()
+
+    # [wall, cpu] seconds spent in each phase of the build, for --profile. Phases can be inside other phases (math conversion happens while
+    # rendering tables and figures, and rendering includes writing pages), so they don't add up to the total. With -j, page phases are summed over the workers
+    def addtime(self, phase, start):
+        if phase not in self.phasetimes.keys():
+            self.phasetimes[phase] = [0.0, 0.0]
+        self.phasetimes[phase][0] += time.perf_counter() - start[0]
+        self.phasetimes[phase][1] += time.process_time() - start[1]
+
+    # convert latex to mathml, going through the math cache first. The same formulas show up over and over, so this saves most of the conversions.
+    # the cache is keyed on display mode and latex source, and kept in least recently used order so the oldest entries get evicted when it is full
+    def convertmath(self, latex, display='inline'):
+        key = display + ':' + latex
+        if self.mathcachesize > 0 and key in self.mathcache:
+            self.mathcachestats['hits'] += 1
+            self.cachemath(key, self.mathcache[key])
+            if isinstance(self.mathcache[key], list):
+                return self.mathfailed(latex, display, self.mathcache[key][1], False)
+            return self.mathcache[key]
+        self.mathcachestats['misses'] += 1
+        start = clock()
+        mathml = fastmath(latex, display) if fastmathtrusted() else None
+        error = None
+        transient = False
+        if mathml is not None:
+            self.mathcachestats['fast'] += 1
+        elif key in self.mathfailures.keys():
+            error = self.mathfailures[key] # it already timed out or crashed, so don't wait on it again
+            transient = True
+        elif (latex, display) in self.mathprefetched.keys():
+            mathml, error, transient = self.mathprefetched[(latex, display)]
+        elif self.mathtimeout > 0:
+            mathml, error, transient = poolconvert([[latex, display]], self.mathtimeout, self.mathmemory, 1)[(latex, display)]
+        else:
+            import latex2mathml.converter
+            try:
+                mathml = latex2mathml.converter.convert(latex, display=display)
+            except Exception as err:
+                error = matherror(err)
+                transient = isinstance(err, MemoryError)
+        self.addtime('math conversion', start)
+        # an error latex2mathml raises will be raised again, so it goes in the math cache like mathml, as [None, error], and is thrown out with the rest
+        # when latex2mathml is upgraded. Timeouts and crashes aren't cached: they are kept in self.mathfailures, so a --watch doesn't wait on them
+        # at every rebuild, and the page is marked in the manifest, so the next build tries them again
+        if error is not None:
+            if transient:
+                self.mathfailures[key] = error
+            else:
+                self.cachemath(key, [None, error])
+            return self.mathfailed(latex, display, error, transient)
+        self.cachemath(key, mathml)
+        return mathml
+
+    # what goes on the page for math that couldn't be converted. The build reports where it was (see mathsource)
+    def mathfailed(self, latex, display, error, transient):
+        self.matherrors.append({'page': self.mathsource[0], 'file': self.mathsource[1], 'line': self.mathsource[2], 'latex': latex, 'display': display, 'error': error, 'transient': transient})
+        return mathplaceholder(latex, display, error)
+
+    # put a formula in the math cache, or move it to the newest end, for the shared cache and for this site
+    def cachemath(self, key, mathml):
+        if self.mathcachesize <= 0:
+            return
+        self.mathcache[key] = mathml
+        self.mathcache.move_to_end(key)
+        self.mathcachenew[key] = mathml
+        self.mathkeys[key] = True
+        self.mathkeys.move_to_end(key)
+        while len(self.mathcache) > max(sharedmathcachesize, self.mathcachesize):
+            self.mathcache.popitem(last=False)
+        while len(self.mathkeys) > self.mathcachesize:
+            self.mathkeys.popitem(last=False)
+
+    # convert the formulas that are about to be needed all at once, spread over the math workers (see poolconvert), instead of one at a time as they
+    # come up. Only what isn't cached and fastmath can't do goes, and convertmath picks the results up from self.mathprefetched
+    def prefetchmath(self, formulas):
+        if self.mathtimeout <= 0:
+            return
+        tofetch = []
+        for latex, display in formulas:
+            key = display + ':' + latex
+            if (self.mathcachesize > 0 and key in self.mathcache) or key in self.mathfailures.keys() or (latex, display) in tofetch or (fastmathtrusted() and fastmath(latex, display) is not None):
+                continue
+            tofetch.append((latex, display))
+        if len(tofetch) > 0:
+            start = clock()
+            self.mathprefetched.update(poolconvert(tofetch, self.mathtimeout, self.mathmemory, self.mathworkers))
+            self.addtime('math conversion', start)
+
+    # math on the page being written, with the label if it is an equation. Inside a deferred chunk (see deferscript) the mathml is saved for the chunk's
+    # <template>, and the page gets the source instead. Math that couldn't be converted is never deferred, since it isn't mathml
+    def pagemath(self, latex, display, label, source):
+        mathml = self.convertmath(latex, display)
+        if label != '':
+            mathml = mathml[:5] + " id='" + label + "'" + mathml[5:]
+        if self.deferredmath is None or not mathml.startswith('<math'):
+            return mathml
+        self.deferredmath.append(mathml)
+        return '<code class=texsite-math' + (" id='" + label + "'" if label != '' else '') + (' style="display: block"' if display == 'block' else '') + '>' + escape(source) + '</code>'
+
+    # end the deferred chunk being written, if there is one, with the mathml it saved
+    def closechunk(self, target, minify):
+        if self.deferredmath is None:
+            return
+        html = ('<template>' + ''.join(self.deferredmath) + '</template>' if len(self.deferredmath) > 0 else '') + '</section>'
+        target.write(minifyhtml(html) if minify else html)
+        self.deferredmath = None
+
+    # the latex for an equation node. The number goes in as text on the line before the end, since \tag does not work, and equation* gets the same padding without it
+    def equationlatex(self, node):
+        body = list(node['body'])
+        if len(body) > 1 and node['type'] == 'equation':
+            # line before end, remove any new line characters, then add the number and \n
+            body[-2] = body[-2].strip() + '\\;' * 18 + ' \\text{(' + self.mapping[node['label']] + ')}\n'
+        elif len(body) > 1:
+            body[-2] = body[-2].strip() + '\\;' * 22
+        return node['begin'] + ''.join(body)
+
+    # the nodes of a page. Most pages are parsed once and kept in self.pagetrees, but pages bigger than --stream-above are read and parsed
+    # again from the file every time they are walked, so only one node of them is in memory at a time
+    def pagenodes(self, fname):
+        if fname in self.pagetrees.keys():
+            yield from self.pagetrees[fname]
+            return
+        with open(os.path.join(os.getcwd(), self.rootdir, fname)) as file:
+            yield from iterpage(file, fname)
+
+    # turn a list of inline tokens into html. citestate holds the keys in the page's bib file and the numbers given to the articles cited so far
+    def renderinline(self, tokens, fname, citestate):
+        html = ''
+        for kind, value in tokens:
+            if kind == 'text':
+                html += value
+            elif kind == 'math':
+                html += self.pagemath(value, 'inline', '', value)
+            elif kind == 'ref':
+                mappingoflabel = '??'
+                linkmappingoflabel = fname.split('.')[0] + '.html'
+                if value in self.mapping.keys():
+                    # it is a valid label, so we should grab the actual self.mapping and self.linkmapping
+                    mappingoflabel = self.mapping[value]
+                    linkmappingoflabel = self.linkmapping[value]
+                html += "<a href='" + linkmappingoflabel + "'>" + mappingoflabel + "</a>"
+            elif kind == 'cite':
+                html += self.formatcite(value, citestate)
+        return html
+
+    # \cite{key,key,key,...} becomes [1, 3-5, ??], numbering articles in the order they are first cited on the page
+    def formatcite(self, keylist, citestate):
+        start = clock()
+        citedarticles = citestate['cited']
+        citestate['citations'] += len(keylist)
+        vallist = []
+        unknowns = 0
+        for key in keylist:
+            if key not in citedarticles.keys() and key.lower() in citestate['keys']:
+                # it is in the bibliography, add it
+                citedarticles[key] = len(citedarticles.values()) + 1
+            if key in citedarticles.keys():
+                vallist.append(citedarticles[key])
+            else:
+                unknowns += 1 # default is ??
+
+        vallist = sorted(vallist)
+        # replace consecutives with a-b
+        kkind = 0
+        while kkind+2 < len(vallist):
+            if vallist[kkind+2] - vallist[kkind] == 2:
+                # we have consecutives
+                runind = kkind+2
+                while runind < len(vallist) and vallist[runind] - vallist[kkind] == runind-kkind:
+                    runind += 1
+
+                vallist[kkind:runind] = [str(vallist[kkind]) + '-' + str(vallist[runind-1])]
+
+            kkind += 1
+        vallist += ['??'] * unknowns
+        self.addtime('citation numbering', start)
+        return '[' + ', '.join([str(vv) for vv in vallist]) + ']'
+
+    # start one html file of a page: the whole page, or with --split-above, one \section of it (the first part also gets everything before the first \section).
+    # Streamed pages are written straight to the file as they go, the rest are put together in memory. Everything after the bibliography goes to a separate
+    # buffer (spilling to disk if it gets big), so the bibliography can be filled in once everything is cited
+    def openpart(self, fname, part, streamed):
+        parts = self.pageparts[fname]
+        pagepart = {'path': os.path.join(os.getcwd(), self.rootdir, parts[part]), 'after': None, 'deferred': False}
+        pagepart['out'] = open(pagepart['path'] + '.part', 'w') if streamed else io.StringIO()
+        # check for a bibliography to make. The entries were already formatted, so this just needs the keys that can be cited. Each part numbers its citations from 1
+        pagepart['citestate'] = {'cited': dict(), 'keys': set(), 'citations': 0} # no keys so that cite just gives ?? if something is wrong with bib file
+        if fname in self.pagebibs.keys():
+            bibhash, bibstyle = self.pagebibs[fname]
+            pagepart['citestate']['keys'] = set(self.bibkeys[bibhash])
+        # the parts before and after this one are the likely next clicks, so let the browser fetch them early
+        prefetch = ''.join(['<link rel="prefetch" href="' + parts[neighbour] + '">' for neighbour in [part - 1, part + 1] if 0 <= neighbour < len(parts)])
+        pagepart['out'].write('<html><head><title>' + self.sitetitle + ': ' + self.titlerules[fname] + '</title><link rel="stylesheet" href="' + self.stylesheet + '">' + prefetch + '</head><body><div><p><a href=index.html>Table of Contents</a></p>' + '<h1>' + self.titlerules[fname] + '</h1>')
+        return pagepart
+
+    # finish a part with its bibliography and footer, and write it out. Returns the bytes written
+    def closepart(self, fname, part, pagepart, streamed, searchpage):
+        parts = self.pageparts[fname]
+        out = pagepart['out']
+        citestate = pagepart['citestate']
+        minify = streamed and '--minify' in self.options
+
+        # now create and insert the bibliography. On a split page every part that cites anything gets one, at the end if \bibliography is in another part
+        if pagepart['after'] is not None or (len(parts) > 1 and fname in self.pagebibs.keys() and len(citestate['cited']) > 0):
+            invertedcitedarticles = {vv:ke for ke,vv in zip(citestate['cited'].keys(),citestate['cited'].values())}
+            orderedcitedarticles = [invertedcitedarticles[vv+1] for vv in range(len(citestate['cited']))]
+            actuallycitedbibdata = ['<p><li>' + self.bibcache[self.pagebibs[fname][0]]['styles'][self.pagebibs[fname][1]][ke.lower()] + '</li></p>\n' for ke in orderedcitedarticles]
+            bibhtml = "<h2 id='" + fname + '-references' + "'>" + self.mapping[fname + '-references'] + ' References' + '</h2>\n'
+            bibhtml += '<ol>\n' + ''.join(actuallycitedbibdata) + '</ol>\n'
+            out.write(minifyhtml(bibhtml) if minify else bibhtml)
+            # the cited articles are searchable under the references
+            if searchpage is not None:
+                searchpage['docs'].append([parts[part] + '#' + fname + '-references', self.mapping[fname + '-references'] + ' References'])
+                for bibentry in actuallycitedbibdata:
+                    addsearchtext(searchpage, len(searchpage['docs']) - 1, plaintext(bibentry), 1)
+            if pagepart['after'] is not None:
+                pagepart['after'].seek(0)
+                shutil.copyfileobj(pagepart['after'], out)
+                pagepart['after'].close()
+
+        # write the whole thing to html
+        # first append links to the other parts of a split page, toc link and div part again, and add watermark
+        footer = ''
+        if len(parts) > 1:
+            footer += '<p>' + ' | '.join(['<a href=' + parts[neighbour] + '>' + linktext + '</a>' for neighbour, linktext in [[part - 1, 'Previous section'], [part + 1, 'Next section']] if 0 <= neighbour < len(parts)]) + '</p>'
+        footer += '<p><a href=index.html>Table of Contents</a></p>' + '<p class=texsite>This is a <a href="https://github.com/cdkocher/teXsite" target="_blank">teXsite</a>.</p>' + (deferscript if pagepart['deferred'] else '') + '</body></html>' + '</div>'
+        out.write(minifyhtml(footer) if minify else footer)
+        start = clock()
+        if streamed:
+            out.close()
+            finishoutput(pagepart['path'])
+            outputbytes = os.path.getsize(pagepart['path'])
+        else:
+            writeoutput(pagepart['path'], out.getvalue(), '--minify' in self.options)
+            outputbytes = os.path.getsize(pagepart['path']) # after minifying
+        self.addtime('write', start)
+        return outputbytes
+
+    # where a page links to an image. With --fingerprint it is the copy with the content hash in its name
+    def imagesrc(self, figureFname):
+        if '--fingerprint' in self.options and figureFname in self.imageinfo.keys():
+            return 'images/' + fingerprintname(figureFname, self.imageinfo)
+        return 'images/' + figureFname
+
+    # the rows of a table from the csv or tsv file given with \includedata, written to target a chunk of rows at a time, so the table is never in memory whole.
+    # Only cells with $$ in them go through the math converter. The rendered rows are saved in .texsite/tables, named by the hash of the file and everything else
+    # they depend on, and copied from there until the file changes. Returns the name of that fragment
+    def writedatarows(self, fname, node, target, minify):
+        dataFname = os.path.join(os.getcwd(), self.rootdir, node['data'])
+        if node['data'] not in self.datahashes.keys() or self.datahashes[node['data']] == '':
+            raise TexsiteError('{}, line {}: table {} can\'t find its data file {}'.format(fname, node['line'], node['label'], node['data']))
+        header = len(node['rows']) == 0 # without rows typed in the page, the first row of the file is the header
+        fragment = hashstring(':'.join([versionnumber, self.latex2mathmlversion, self.datahashes[node['data']], os.path.splitext(dataFname)[1].lower(), str(header), str(minify)])) + '.html'
+        fragmentFname = os.path.join(os.getcwd(), self.rootdir, '.texsite', 'tables', fragment)
+        if os.path.exists(fragmentFname):
+            with open(fragmentFname) as file:
+                shutil.copyfileobj(file, target)
+            return fragment
+
+        Path(os.path.dirname(fragmentFname)).mkdir(parents=True, exist_ok=True)
+        errors = len(self.matherrors)
+        pageprefetched = self.mathprefetched # the rest of the page's math, for after the table
+        with open(dataFname, newline='') as datafile, open(fragmentFname + '.part', 'w') as fragmentfile:
+            reader = csv.reader(datafile, delimiter='\t' if dataFname.lower().endswith('.tsv') else ',')
+            while True:
+                # read a chunk of rows, convert all their math at once, then write them out
+                chunk = []
+                for row in reader:
+                    # same rule as in the page, odds between $$ are math
+                    chunk.append([reader.line_num, [[colspan, data.split('$$')] for colspan, data in [tablecell(tabentry, node['data'], reader.line_num) for tabentry in row]]])
+                    if len(chunk) == 1000:
+                        break
+                if len(chunk) == 0:
+                    break
+                self.mathprefetched = dict()
+                self.prefetchmath([[pieces[ii], 'inline'] for line, cells in chunk for colspan, pieces in cells if len(pieces) >= 3 for ii in range(1, len(pieces), 2)])
+                rows = []
+                for line, cells in chunk:
+                    self.mathsource = [fname, node['data'], line]
+                    tagtype = 'th' if header else 'td'
+                    header = False
+                    html = '<tr>'
+                    for colspan, pieces in cells:
+                        data = ''.join([self.convertmath(pieces[ii]) if ii % 2 == 1 else pieces[ii] for ii in range(len(pieces))]) if len(pieces) >= 3 else '$$'.join(pieces)
+                        html += '<' + tagtype + (' colspan="' + colspan + '"' if colspan != '' else '') + '>' + data + '</' + tagtype + '>'
+                    rows.append(html + '</tr>')
+                rows = minifyhtml(''.join(rows)) if minify else ''.join(rows)
+                target.write(rows)
+                fragmentfile.write(rows)
+        self.mathprefetched = pageprefetched
+        # written under another name first, so an interrupted build never leaves half a table that looks cached. Rows with math that couldn't be converted aren't kept
+        if len(self.matherrors) > errors:
+            os.remove(fragmentFname + '.part')
+        else:
+            os.replace(fragmentFname + '.part', fragmentFname)
+        return fragment
+
+    # each page only needs the (read only) maps from the label pass, so they can be rendered independently, in parallel with -j.
+    # renderpage writes the html for one page and returns what the main process needs to know about it
+    def renderpage(self, fname):
+        self.mathcachenew.clear()
+        hits = self.mathcachestats['hits']
+        misses = self.mathcachestats['misses']
+        fast = self.mathcachestats['fast']
+        errors = len(self.matherrors)
+        pagephasetimes = {phase: list(self.phasetimes[phase]) for phase in self.phasetimes.keys()}
+        pagestart = clock()
+        profiler = None
+        if optionvalue(self.options, '--profile-page', '') == fname:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        # now walk the tree and write out each node, to one html file, or with --split-above, one for each \section (see openpart)
+        # pages with \includedata are written straight to the file too, however small their source, since the rows of a data table can be any size
+        streamed = fname not in self.pagetrees.keys() or any([node['type'] == 'table' and node['data'] != '' for node in self.pagetrees[fname]])
+        self.mathprefetched = dict()
+        if fname in self.pagetrees.keys():
+            formulas = []
+            for node in self.pagetrees[fname]:
+                if node['type'] in ['equation', 'equation*']:
+                    formulas.append([self.equationlatex(node), 'block'])
+                formulas += [[value, 'inline'] for kind, value in nodetokens(node) if kind == 'math']
+            self.prefetchmath(formulas)
+        minify = streamed and '--minify' in self.options # the rest are minified all at once by writeoutput
+        part = 0
+        pagepart = self.openpart(fname, part, streamed)
+        citestate = pagepart['citestate']
+        sections = 0
+        outputbytes = 0
+        citations = 0
+        foldbudget = foldcharacters # text left before the fold
+        deferring = self.mathfold is not None and self.pagedefermath[fname]
+        deferbudget = self.mathfold # text left before math is deferred
+        self.deferredmath = None
+        tables = 0
+        figures = 0
+        tablefragments = [] # the rendered data tables in .texsite/tables this page used
+        # with --search, the words of each document on the page. terms is word : {document number : weight}, and paragraphs count toward the section they are in
+        searchpage = None
+        if '--search' in self.options:
+            searchpage = {'docs': [[fname.split('.')[0] + '.html', self.titlerules[fname]]], 'terms': dict(), 'section': 0}
+            addsearchtext(searchpage, 0, self.titlerules[fname], headingweight)
+        for node in self.pagenodes(fname):
+            self.mathsource = [fname, fname, node['line']]
+            # a split page starts a new file at every \section after the first
+            if node['type'] == 'section' and len(self.pageparts[fname]) > 1:
                 sections += 1
-                mapping[label] = compilerules[fname] + '.' + str(sections)
-                #linkmapping[label] = '/' + fname + '#' + label
-                linkmapping[label] = fname.split('.')[0] + '.html' + '#' + label
-                # start over on subsections and subsubsections
-                subsections = 0
-                subsubsections = 0
-                # add substructure line for printing on TOC
-                substructuremap[fname].append('<h3><pre>   <a href="' + linkmapping[label] + '">' + mapping[label] + ' ' + sectionname + '</a></pre></h3>')
-                
-            if '\\subsection' in nocommentsline:
-                # add a subsection
-                sectionname = nocommentsline.split('}{')[0].split('{')[1]
-                label = nocommentsline.split('}{')[1].split('}')[0] # cut out that last }
-                # increment subsections
-                subsections += 1
-                mapping[label] = compilerules[fname] + '.' + str(sections) + '.' + str(subsections)
-                #linkmapping[label] = '/' + fname + '#' + label
-                linkmapping[label] = fname.split('.')[0] + '.html' + '#' + label
-                # add substructure line for printing on TOC
-                substructuremap[fname].append('<h4><pre>            <a href="' + linkmapping[label] + '">' + mapping[label] + ' ' + sectionname + '</a></pre></h4>')
-                
-            if '\\begin{figure}' in nocommentsline:
-                # add a figure
-                label = nocommentsline.split('}{')[1].split('}')[0] # cut out that last }
-                # increment figures
+                if sections > 1:
+                    self.closechunk(pagepart['out'] if pagepart['after'] is None else pagepart['after'], minify)
+                    outputbytes += self.closepart(fname, part, pagepart, streamed, searchpage)
+                    citations += citestate['citations']
+                    part += 1
+                    pagepart = self.openpart(fname, part, streamed)
+                    citestate = pagepart['citestate']
+                    foldbudget = foldcharacters
+                    deferbudget = self.mathfold
+
+            # with --defer-math, below the fold every section and subsection starts a new chunk. The bibliography ends one, since what comes after it is written elsewhere
+            if deferring and deferbudget <= 0:
+                if node['type'] in ['section', 'subsection', 'bibliography']:
+                    self.closechunk(pagepart['out'] if pagepart['after'] is None else pagepart['after'], minify)
+                if self.deferredmath is None and node['type'] != 'bibliography':
+                    chunkstart = '<section class=texsite-deferred>'
+                    if not pagepart['deferred']:
+                        chunkstart = '<noscript><p>The math below is shown as LaTeX, since it needs JavaScript to be typeset.</p></noscript>' + chunkstart
+                    (pagepart['out'] if pagepart['after'] is None else pagepart['after']).write(minifyhtml(chunkstart) if minify else chunkstart)
+                    pagepart['deferred'] = True
+                    self.deferredmath = []
+
+            # everything else is wrapped in <p>
+            if node['type'] == 'paragraph':
+                newline = '<p>' + self.renderinline(node['tokens'], fname, citestate) + '</p>'
+
+            # deal with sections and subsections
+            elif node['type'] == 'section':
+                newline = "<h2 id='" + node['label'] + "'>" + self.mapping[node['label']] + ' ' + self.renderinline(node['tokens'], fname, citestate) + '</h2>\n'
+
+            elif node['type'] == 'subsection':
+                newline = "<h3 id='" + node['label'] + "'>" + self.mapping[node['label']] + ' ' + self.renderinline(node['tokens'], fname, citestate) + '</h3>\n'
+
+            # deal with equations. make the mathml and put the label at the right spot
+            elif node['type'] == 'equation':
+                newline = self.pagemath(self.equationlatex(node), 'block', node['label'], ''.join(node['body'][:-1]).strip() + ' (' + self.mapping[node['label']] + ')')
+
+            # deal with equation*. No number, but still insert the padding
+            elif node['type'] == 'equation*':
+                newline = self.pagemath(self.equationlatex(node), 'block', '', ''.join(node['body'][:-1]).strip())
+
+            elif node['type'] == 'nodefermath':
+                newline = ''
+
+            # deal with figures
+            elif node['type'] == 'figure':
+                start = clock()
+                # <figure><img src="images/figureFname" srcset="..." sizes="..." width="w" height="h" alt="caption" style="width:100*multiple%"><figcaption>Fig label caption</figcaption></figure>
+                # math and refs in the caption are only for the display, not for the alt
+                percent = int(100*node['scale'])
+                newline = '<figure id="' + node['label'] + '"><img src="' + self.imagesrc(node['file']) + '"'
+                info = self.imageinfo.get(node['file'])
+                if info is not None and info['width'] is not None:
+                    widths = imagevariants(node['file'], self.imageinfo)
+                    if len(widths) > 0:
+                        # the page is at most 1000px wide, and the figure takes up its scale of that
+                        srcset = ['images/' + variantname(node['file'], width, self.imageinfo) + ' ' + str(width) + 'w' for width in widths] + [self.imagesrc(node['file']) + ' ' + str(info['width']) + 'w']
+                        newline += ' srcset="' + ', '.join(srcset) + '" sizes="(max-width: 1000px) ' + str(percent) + 'vw, ' + str(10*percent) + 'px"'
+                    newline += ' width="' + str(info['width']) + '" height="' + str(info['height']) + '"'
+                newline += ' alt="' + node['caption'] + '" style="width:' + str(percent) + '%"'
+                if foldbudget <= 0:
+                    newline += ' loading="lazy" decoding="async"'
+                newline += '>'
+                newline += '<figcaption><b>Fig ' + self.mapping[node['label']] + '</b> ' + self.renderinline(node['tokens'], fname, citestate) + '</figcaption></figure>'
                 figures += 1
-                mapping[label] = compilerules[fname] + '.' + str(figures)
-                #linkmapping[label] = '/' + fname + '#' + label
-                linkmapping[label] = fname.split('.')[0] + '.html' + '#' + label
-                
-            if '\\begin{table}' in nocommentsline:
-                # add a table
-                label = nocommentsline.split('}{')[1].split('}')[0] # cut out that last }
-                # increment figures
+                self.addtime('table/figure rendering', start)
+
+            # deal with tables, first row is the header
+            elif node['type'] == 'table':
+                start = clock()
+                newline = '<figure id="' + node['label'] + '"><table>'
+                for rowindex in range(len(node['rows'])):
+                    tagtype = 'th' if rowindex == 0 else 'td'
+                    newline += '<tr>'
+                    for cell in node['rows'][rowindex]:
+                        colspantext = ''
+                        if cell['colspan'] != '':
+                            colspantext = ' colspan="' + cell['colspan'] + '"'
+                        newline += '<' + tagtype + colspantext + '>' + self.renderinline(cell['tokens'], fname, citestate) + '</' + tagtype + '>'
+                    newline += '</tr>'
+                # rows from a data file go straight into the output, after the rows typed in the page
+                if node['data'] != '':
+                    (pagepart['out'] if pagepart['after'] is None else pagepart['after']).write(minifyhtml(newline) if minify else newline)
+                    tablefragments.append(self.writedatarows(fname, node, pagepart['out'] if pagepart['after'] is None else pagepart['after'], minify))
+                    newline = ''
+                newline += '</table>'
+                newline += '<figcaption><b>Tab ' + self.mapping[node['label']] + '</b> ' + self.renderinline(node['tokens'], fname, citestate) + '</figcaption></figure>'
                 tables += 1
-                mapping[label] = compilerules[fname] + '.' + str(tables)
-                #linkmapping[label] = '/' + fname + '#' + label
-                linkmapping[label] = fname.split('.')[0] + '.html' + '#' + label
-                
-            if '\\begin{equation}' in nocommentsline: # here we only give a single equation number to an align..... is that ok?
-                # add an equation
-                label = nocommentsline.split('}{')[1].split('}')[0] # cut out that last }
-                # increment equations
-                equations += 1
-                mapping[label] = compilerules[fname] + '.' + str(equations)
-                #linkmapping[label] = '/' + fname.split('.')[0] + '.html' + '#' + label
-                linkmapping[label] = fname.split('.')[0] + '.html' + '#' + label
-                
-# and that should conclude the map. No need to store it to a file
-
-# may want to add compilerules so we can reference pages themselves, not just sections.
-
-for page in compilerules.keys():
-    mapping[page] = compilerules[page]
-    #linkmapping[page] = '/' + page.split('.')[0] + '.html'
-    linkmapping[page] = page.split('.')[0] + '.html'
-
-#print(mapping)
-
-# next, we go through each file and make our replacements, then write it to an html file
-
-usedfigureFnames = [] # keep these for copying later with -e flag if necessary
-
-for fname in tocompileFnames:
-    # open the file and get the lines
-    with open(os.path.join(os.getcwd(), rootdir, fname)) as file:
-        lines = list(file)
-
-    # check for a bibliography to make
-    filestring = ''.join(lines)
-    bib_data = dict() # empty dict so that cite just gives ?? if something is wrong with bib file
-    citedarticles = dict() # this keeps the map of key:ref number for us. Later, use citedarticles.values() to actually make the bibliography
-    bibexists = 0 # have to account for comments
-    for ln in filestring.split('\n'):
-        if '\\bibliography' in ln.split('##')[0]:
-            bibexists = 1
-            
-    if bibexists:
-        # grab the bib file we are making the bibliography from and the style
-        bibfname = filestring.split('\\bibliography{')[1].split('}{')[0] # \\bibliography{file.bib}{style}
-        bibstyle = filestring.split('\\bibliography{')[1].split('}{')[1].split('}')[0] # \\bibliography{file.bib}{style}
-        # get full bibfname
-        bibfname = os.path.join(os.getcwd(), rootdir, bibfname)
-        # check that it exists, then do it
-        if os.path.exists(bibfname):
-            # it does exist, so do it
-            # process the file, getting all possible bib keywords that could appear in cite
-            bib_data = parse_file(bibfname) # bib_data.entries holds key:data information
-        
-    # now that we have the lines, loop through and do our replacements
-    newlines = ['<html><head><title>' + sitetitle + ': ' + titlerules[fname] + '</title><link rel="stylesheet" href="style.css"></head><body><div><p><a href=index.html>Table of Contents</a></p>','<h1>' + titlerules[fname] + '</h1>']
-    kk = 0
-    while kk < (len(lines)):
-        currentline = lines[kk].split('##')[0] # split off any comments
-        newline = '<p>' + str(currentline) + '</p>' # str to stop copy issues, wrap in <p> for default behavior.
-        # deal with sections
-        if '\\section' in currentline:
-            heading = currentline.split('}{')[0].split('{')[1] # cut out the beginning
-            label = currentline.split('}{')[1].split('}')[0] # cut out that last }
-            newline = "<h2 id='" + label + "'>" + mapping[label] + ' ' + heading + '</h2>\n'
-            
-        # deal with subsections
-        if '\\subsection' in currentline:
-            heading = currentline.split('}{')[0].split('{')[1] # cut out the beginning
-            label = currentline.split('}{')[1].split('}')[0] # cut out that last }
-            newline = "<h3 id='" + label + "'>" + mapping[label] + ' ' + heading + '</h3>\n'
-            
-        # deal with ref
-        if '\\ref' in currentline:
-            # split along the refs
-            splitcurrentline = currentline.split('\\ref{')
-            newline = splitcurrentline[0]
-            for jj in range(1,len(splitcurrentline)):
-                label = splitcurrentline[jj].split('}')[0]
-                mappingoflabel = '??'
-                linkmappingoflabel = fname.split('.')[0] + '.html'
-                if label in mapping.keys():
-                    # it is a valid label, so we should grab the actual mapping and linkmapping
-                    mappingoflabel = mapping[label]
-                    linkmappingoflabel = linkmapping[label]
-                    
-                newline += "<a href='" + linkmappingoflabel + "'>" + mappingoflabel + "</a>" + '}'.join(splitcurrentline[jj].split('}')[1:])
-                
-            newline = '<p>' + newline + '</p>'
-                
-        # deal with equations
-        if '\\begin{equation}' in currentline:
-            # find all lines we need to take
-            jj = 0
-            while '\\end{equation}' not in lines[kk+jj]:
-                jj += 1
-                
-            # once we get here, lines[kk+jj] is the corresponding end. So, now use \tag{mapping[label]} instead of {label} and we're set
-            label = currentline.split('}{')[1].split('}')[0] # cut out that last }
-            #newline = currentline.split('}')[0] + '} \\tag{' + mapping[label] + '}\n'
-            #newline = currentline.split('}')[0] + '}\n \\text{(' + mapping[label] + ')}\;\;\;\;\;\;\;\;\;\;\;'
-            newline = currentline.split('}')[0] + '}\n' 
-            latexbody = ''
-            latexbody += newline
-            for nn in range(1,jj+1):
-                # insert the equation number
-                if nn==jj-1:
-                    # line before end, remove any new line characters, then add the number and \n
-                    lines[kk+nn] = lines[kk+nn].strip() + '\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\; \\text{(' + mapping[label] + ')}\n'
-                    
-                latexbody += lines[kk+nn]
-            
-            # make the mathml and put it at the right spot
-            newline = latex2mathml.converter.convert(latexbody,display="block")
-            newline = newline[:5] + " id='" + label + "'" + newline[5:]
-            #print(latexbody)
-            kk += jj # skip to the appropriate place after all the equation body   
-            
-        # deal with equation*
-        if '\\begin{equation*}' in currentline:
-            # find all lines we need to take
-            jj = 0
-            while '\\end{equation*}' not in lines[kk+jj]:
-                jj += 1
-                
-            # once we get here, lines[kk+jj] is the corresponding end. No label to grab
-            #label = currentline.split('}{')[1].split('}')[0] # cut out that last }
-            #newline = currentline.split('}')[0] + '} \\tag{' + mapping[label] + '}\n'
-            #newline = currentline.split('}')[0] + '}\n \\text{(' + mapping[label] + ')}\;\;\;\;\;\;\;\;\;\;\;'
-            #newline = currentline
-            latexbody = ''
-            latexbody += currentline
-            for nn in range(1,jj+1):
-                # No need to insert the equation number, but still insert the padding
-                if nn==jj-1:
-                    # line before end, remove any new line characters, then add the number and \n
-                    lines[kk+nn] = lines[kk+nn].strip() + '\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;\;'
-                    
-                latexbody += lines[kk+nn]
-            
-            # make the mathml and put it at the right spot
-            newline = latex2mathml.converter.convert(latexbody,display="block")
-            #newline = newline[:5] + " id='" + label + "'" + newline[5:]
-            #print(latexbody)
-            kk += jj # skip to the appropriate place after all the equation body 
-            
-        # deal with figures 
-        if '\\begin{figure}' in currentline:
-            # take this line, next line (which is include graphics), next line (which is caption), and next line (which is \\end{figure})
-            label = currentline.split('}{')[1].split('}')[0] # cut out that last }
-            figureFname = lines[kk+1].split('}')[0].split('{')[1]
-            usedfigureFnames.append(os.path.join(os.getcwd(), rootdir, 'images', figureFname))
-            multiple = 1
-            if '}{' in lines[kk+1]:
-                # we have some scaling to deal with
-                multiple = lines[kk+1].split('}{')[1].split('}')[0]
-                
-            caption = '}'.join(('{'.join(lines[kk+2].split('{')[1:])).split('}')[:-1]) # do it this way just in case {} are in the caption itself                   
-            # now we add <figure><img src="images/figureFname" alt="caption" style="width:100*multiple%"><figcaption>Fig label caption</figcaption></figure>
-            newline = '<figure id="' + label + '"><img src="images/' + figureFname + '" alt="' + caption + '" style="width:' + str(int(100*float(multiple))) + '%">'
-            # now within caption, we need to do any inline math. This is only for the display, not for the alt
-            if '$$' in caption:
-                splitcaption = caption.split('$$')
-                if len(splitcaption) > 2:
-                    # we have format text $$ math $$ text $$ math $$ text ...
-                    newcaption = splitcaption[0]
-                    for jj in range(1,len(splitcaption)):
-                        if jj%2 == 1:
-                            # odds are math
-                            newcaption += latex2mathml.converter.convert(splitcaption[jj])
-                        else:
-                            # evens are text
-                            newcaption += splitcaption[jj]
-                            
-                    caption = str(newcaption)
-                    
-            # also do any refs
-            if '\\ref' in caption:
-                # split along the refs
-                splitcaption = caption.split('\\ref{')
-                newcaption = splitcaption[0]
-                for mm in range(1,len(splitcaption)):
-                    reflabel = splitcaption[mm].split('}')[0]
-                    mappingoflabel = '??'
-                    linkmappingoflabel = fname.split('.')[0] + '.html'
-                    if reflabel in mapping.keys():
-                        # it is a valid label, so we should grab the actual mapping and linkmapping
-                        mappingoflabel = mapping[reflabel]
-                        linkmappingoflabel = linkmapping[reflabel]
-                        
-                    newcaption += "<a href='" + linkmappingoflabel + "'>" + mappingoflabel + "</a>" + '}'.join(splitcaption[mm].split('}')[1:])
-                    
-                caption = newcaption
-            
-            newline += '<figcaption><b>Fig ' + mapping[label] + '</b> ' + caption + '</figcaption></figure>'
-            kk += 3 # we just finished the end figure line
-        
-        # deal with tables, make every line but make the lines light gray for readability 
-        if '\\begin{table}' in currentline:
-            label = currentline.split('}{')[1].split('}')[0] # cut out that last }
-            # find all lines we need to take. should be begin table, table body, caption, end table
-            jj = 0
-            while '\\end{table}' not in lines[kk+jj]:
-                jj += 1
-                
-            # now we need to assemble the table 
-            newline = '<figure id="' + label + '"><table>'
-            for nn in range(1,jj-1):
-                # split along &
-                newline += '<tr>'
-                splittabrow = lines[kk+nn].split('&')
-                for tabentry in splittabrow:
-                    # figure out if we take up more than one column
-                    data = str(tabentry) # avoid copying issues
-                    colspantext = ''
-                    if '\\multicolumn' in tabentry:
-                        colspan = tabentry.split('}{')[0].split('{')[1]
-                        colspantext = ' colspan="' + colspan + '"'
-                        data = tabentry.split('}{')[1].split('}')[0]
-                        
-                    tagtype = 'td'
-                    # if first row, use th
-                    if nn == 1:
-                        tagtype = 'th'
-                        
-                    # deal with math
-                    if '$$' in data:
-                        newdata = ''
-                        # we have math, make sure we have two otherwise skip
-                        splitdata = data.split('$$')
-                        if len(splitdata) > 2:
-                            # text $$ math $$ text $$ math $$ text ...
-                            newdata = splitdata[0]
-                            for mm in range(1,len(splitdata)):
-                                if mm %2 == 1:
-                                    # odds are math
-                                    newdata += latex2mathml.converter.convert(splitdata[mm])
-                                else:
-                                    # evens are text
-                                    newdata += splitdata[mm]
-                                    
-                            data = newdata
-                            
-                    # deal with refs in data TODO
-                    
-                    newline += '<' + tagtype + colspantext + '>' + data + '</' + tagtype + '>'
-                    
-                newline += '</tr>'
-            
-            newline += '</table>'
-            # now do caption. First, pull it
-            caption = '}'.join(('{'.join(lines[kk+jj-1].split('{')[1:])).split('}')[:-1]) # do this in case {} in line
-            # compile math in caption
-            if '$$' in caption:
-                newcaption = ''
-                # we have math, make sure we have two otherwise skip
-                splitcaption = caption.split('$$')
-                if len(splitcaption) > 2:
-                    # text $$ math $$ text $$ math $$ text ...
-                    newcaption = splitcaption[0]
-                    for mm in range(1,len(splitcaption)):
-                        if mm%2 == 1:
-                            # odds are math
-                            newcaption += latex2mathml.converter.convert(splitcaption[mm])
-                        else:
-                            # evens are text
-                            newcaption += splitcaption[mm]
-                            
-                    caption = newcaption
-                    
-            # also do any refs
-            if '\\ref' in caption:
-                # split along the refs
-                splitcaption = caption.split('\\ref{')
-                newcaption = splitcaption[0]
-                for mm in range(1,len(splitcaption)):
-                    reflabel = splitcaption[mm].split('}')[0]
-                    mappingoflabel = '??'
-                    linkmappingoflabel = fname.split('.')[0] + '.html'
-                    if reflabel in mapping.keys():
-                        # it is a valid label, so we should grab the actual mapping and linkmapping
-                        mappingoflabel = mapping[reflabel]
-                        linkmappingoflabel = linkmapping[reflabel]
-                        
-                    newcaption += "<a href='" + linkmappingoflabel + "'>" + mappingoflabel + "</a>" + '}'.join(splitcaption[mm].split('}')[1:])
-                    
-                caption = newcaption
-            
-            newline += '<figcaption><b>Tab ' + mapping[label] + '</b> ' + caption + '</figcaption></figure>'
-            kk += jj # set to the right line, the end table line
-        
-        # deal with inline math, $$ $$
-        if '$$' in currentline:
-            # make sure we have two of them, otherwise just skip it
-            splitcurrentline = currentline.split('$$')
-            if len(splitcurrentline) > 2:
-                # we have format text $$ math $$ text $$ math $$ text ...
-                newline = splitcurrentline[0]
-                for jj in range(1,len(splitcurrentline)):
-                    if jj%2 == 1:
-                        # odds are math
-                        newline += latex2mathml.converter.convert(splitcurrentline[jj])
-                    else:
-                        # evens are text
-                        newline += splitcurrentline[jj]
-                        
-                newline = '<p>' + newline + '</p>'
-        
-        # everything else is wrapped in <p>
-            
-        newlines.append(newline)
-        kk += 1
-
-    # now that we have all the lines, let's find and replace all cites and replace the bibliography command with the actual bibliography
-    biblioindex = ''
-    for kk in range(len(newlines)):
-        nwln = newlines[kk]
-        if '\\cite' in nwln:
-            # words \\cite{key,key,key,...} words \cite{key,key,key,...} words etc...
-            brokenline = nwln.split('\\cite{')
-            for jj in range(1,len(brokenline)):
-                # all start with keylists
-                keystr = brokenline[jj].split('}')[0]
-                keylist = keystr.split(',')
-                keylist = [ky.strip() for ky in keylist] # get rid of spaces etc
-                vallist = [citedarticles[kv] if kv in citedarticles.keys() else '??' for kv in keylist] # default is ??
-                # test keys for in bibliography
-                for hh in range(len(keylist)):
-                    if vallist[hh] == '??' and keylist[hh] in bib_data.entries.keys():
-                        # it is here, add it
-                        citedarticles[keylist[hh]] = len(citedarticles.values()) + 1
-                        vallist[hh] = citedarticles[keylist[hh]]
-
-                # now do the replacement
-                vallist = sorted(vallist)
-                kkind = 0
-                while kkind+2 < len(vallist):
-                    if vallist[kkind+2] - vallist[kkind] == 2:
-                        # we have consecutives
-                        runind = kkind+2
-                        while runind < len(vallist) and vallist[runind] - vallist[kkind] == runind-kkind:
-                            runind += 1
-
-                        vallist[kkind:runind] = [str(vallist[kkind]) + '-' + str(vallist[runind-1])]
-                        
-                    kkind += 1
-                # replace consecutives with a-b
-                brokenline[jj] = '[' + ', '.join([str(vv) for vv in vallist]) + ']' + ''.join(brokenline[jj].split('}')[1:])
-
-            # now rejoin up brokenline
-            newlines[kk] = ''.join(brokenline)
-            
-        if '\\bibliography' in nwln:
-            biblioindex = kk # this is where to put it
-
-    # now create and insert the bibliography
-    if biblioindex != '':
-        invertedcitedarticles = {vv:ke for ke,vv in zip(citedarticles.keys(),citedarticles.values())}
-        orderedcitedarticles = [invertedcitedarticles[vv+1] for vv in range(len(citedarticles))]
-        actuallycitedbibdata = [format_from_string(BibliographyData({ke:bib_data.entries[ke]}).to_string('bibtex'),bibstyle,output_backend='html') for ke in orderedcitedarticles]
-        # now pull just the entries from each and put the correct numbering in
-        #actuallycitedbibdata = ['<dt>' + str(indx+1) + '</dt>\n<dd>' + actuallycitedbibdata[indx].split('<dd>')[1].split('</dd>')[0] + '</li>\n' for indx in range(len(actuallycitedbibdata))]
-        actuallycitedbibdata = ['<p><li>' + actuallycitedbibdata[indx].split('<dd>')[1].split('</dd>')[0] + '</li></p>\n' for indx in range(len(actuallycitedbibdata))]
-        bibhtml = "<h2 id='" + fname + '-references' + "'>" + mapping[fname + '-references'] + ' References' + '</h2>\n'
-        bibhtml += '<ol>\n' + ''.join(actuallycitedbibdata) + '</ol>\n'
-        newlines[biblioindex:biblioindex+1] = bibhtml
-    
-    # write the whole thing to html
-    # first append toc link and div part again, and add watermark
-    newlines.append('<p><a href=index.html>Table of Contents</a></p>')
-    newlines.append('<p class=texsite>This is a <a href="https://github.com/cdkocher/teXsite" target="_blank">teXsite</a>.</p></body></html>')
-    newlines.append('</div>')
-    towrite = ''.join(newlines)
-    with open(os.path.join(os.getcwd(), rootdir, fname.split('.')[0] + '.html'), 'w') as file:
-        file.write(towrite) 
-        
-    #print(''.join(newlines))
-    
-# make stylesheet: 
-csstowrite = "div{max-width: 1000px; position: absolute; left: 50%; transform: translate(-50%,0); text-align: justify;}\n"
-csstowrite += "math{font-size: 20px}\n"
-csstowrite += "figcaption math{font-size: 16px}\n"
-csstowrite += 'p{text-align: justify; font-size: 20px; line-height: 1.5}\n'
-csstowrite += '.texsite{text-align: justify; font-size: 13px; color: gray;}\n'
-csstowrite += 'h1{font-size: 38px}\n'
-csstowrite += 'h2{font-size: 30px}\n'
-csstowrite += 'h3{font-size: 25px}\n'
-csstowrite += 'figcaption{text-align: justify; padding-top: 5px;}\n'
-csstowrite += 'figure{text-align: center;}\n'
-csstowrite += 'table{text-align: center; border: 1px solid #ddd; font-size: 18px;  margin-left: auto; margin-right: auto;}\n'
-csstowrite += 'td{text-align: center; border: 1px solid #ddd;}\n'
-csstowrite += 'th{text-align: center; border: 1px solid #ddd;}\n'
-with open(os.path.join(os.getcwd(), rootdir,'style.css'), 'w') as file:
-    file.write(csstowrite)
-
-# make TOC page with substructure
-tochtml = '<html><head><title>' + sitetitle + '</title><link rel="stylesheet" href="style.css"></head><body><div>'
-# if we have a backto command, then we need to put the link at the top
-if backtotext != '' and backtolink != '':
-    tochtml += '<p><a href="' + backtolink + '">Back to ' + backtotext + '</a></p>'
-tochtml += '<h1>' + sitetitle + '</h1><p>By: ' + siteauthor + '</p><h2>Table of Contents</h2>'
-with open(tocFname) as f:
-    for line in f:
-        newline = str(line).split('##')[0]
-        # if \include is here, make a link
-        if '\\include' in newline:
-            currentfname = newline.split('}{')[0].split('{')[1]
-            newline = "<h2><a href='" + newline.split('}{')[0].split('{')[1].split('.')[0] + '.html' + "'>" + newline.split('}{')[1] + ' ' + newline.split('}{')[2].split('}')[0] + "</a></h2>"
-            # now add substructure
-            for substructurestring in substructuremap[currentfname]:
-                newline += substructurestring
-
-        elif '\\title' in newline or '\\author' in newline or '\\backto' in newline:
-            # just skip these
-            newline = ''
+                self.addtime('table/figure rendering', start)
+
+            # the bibliography goes in once everything is cited, so just save the spot. If there is more than one, it goes at the last one
+            elif node['type'] == 'bibliography':
+                newline = ''
+                if pagepart['after'] is not None:
+                    pagepart['after'].seek(0)
+                    shutil.copyfileobj(pagepart['after'], pagepart['out'])
+                    pagepart['after'].close()
+                pagepart['after'] = tempfile.SpooledTemporaryFile(max_size=1 << 24, mode='w+')
 
+            if searchpage is not None:
+                if node['type'] in ['section', 'subsection']:
+                    searchpage['section'] = len(searchpage['docs'])
+                    searchpage['docs'].append([self.linkmapping[node['label']], self.mapping[node['label']] + ' ' + tokentext(node['tokens'])])
+                    addsearchtext(searchpage, searchpage['section'], tokentext(node['tokens']), headingweight)
+                elif node['type'] in ['figure', 'table']:
+                    searchpage['docs'].append([self.linkmapping[node['label']], ('Fig ' if node['type'] == 'figure' else 'Tab ') + self.mapping[node['label']] + ' ' + tokentext(node['tokens'])])
+                    addsearchtext(searchpage, len(searchpage['docs']) - 1, tokentext(node['tokens']), captionweight - 1)
+                    addsearchtext(searchpage, len(searchpage['docs']) - 1, tokentext(nodetokens(node)), 1) # the caption again, and the table cells
+                elif node['type'] == 'paragraph':
+                    addsearchtext(searchpage, searchpage['section'], tokentext(node['tokens']), 1)
+
+            # minifying a node at a time gives the same html as minifying the whole page, since every node is whole elements
+            if minify:
+                newline = minifyhtml(newline)
+            (pagepart['out'] if pagepart['after'] is None else pagepart['after']).write(newline)
+            foldbudget -= nodeheight(node)
+            if deferring:
+                deferbudget -= nodeheight(node)
+
+        self.closechunk(pagepart['out'] if pagepart['after'] is None else pagepart['after'], minify)
+        outputbytes += self.closepart(fname, part, pagepart, streamed, searchpage)
+        citations += citestate['citations']
+        self.mathprefetched = dict()
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.splitext(optionvalue(self.options, '--profile', 'profile.json'))[0] + '.prof')
+
+        # a worker process has its own copy of the math cache and timings, so send back anything it converted and how long things took
+        pagephasetimes = {phase: [self.phasetimes[phase][0] - pagephasetimes.get(phase, [0.0, 0.0])[0], self.phasetimes[phase][1] - pagephasetimes.get(phase, [0.0, 0.0])[1]] for phase in self.phasetimes.keys()}
+        counters = {'wall': time.perf_counter() - pagestart[0], 'cpu': time.process_time() - pagestart[1], 'lines': self.pagelinecounts.get(fname, 0),
+                    'math conversions': self.mathcachestats['misses'] - misses, 'math cache hits': self.mathcachestats['hits'] - hits, 'math fast path': self.mathcachestats['fast'] - fast, 'math time': pagephasetimes.get('math conversion', [0.0])[0],
+                    'tables': tables, 'figures': figures, 'citations': citations, 'output bytes': outputbytes}
+        if searchpage is not None:
+            searchpage = {'docs': searchpage['docs'], 'terms': {word: [[doc, weight] for doc, weight in searchpage['terms'][word].items()] for word in searchpage['terms'].keys()}}
+        return {'mathcache': list(self.mathcachenew.items()), 'hits': self.mathcachestats['hits'] - hits, 'misses': self.mathcachestats['misses'] - misses, 'fast': self.mathcachestats['fast'] - fast, 'phasetimes': pagephasetimes, 'counters': counters, 'search': searchpage, 'tables': tablefragments, 'matherrors': self.matherrors[errors:]}
+
+    # sync the compiled site into publichtml: copy what changed, skip what didn't, and remove anything that is no longer part of the site
+    def exportsite(self, usedFnames, usedfigureFnames):
+        if '--atomic' in self.options:
+            return self.exportgeneration(usedFnames, usedfigureFnames)
+        publichtmldir = os.path.join(os.getcwd(), self.rootdir, 'publichtml')
+        if os.path.islink(publichtmldir):
+            raise TexsiteError('{} is a generation from -e --atomic, so it can only be exported to with --atomic'.format(publichtmldir))
+        publichtmlimagesdir = os.path.join(publichtmldir, 'images')
+        Path(publichtmlimagesdir).mkdir(parents=True, exist_ok=True)
+        # target : source. Several figures can use the same image, so this also gets rid of duplicates
+        targets = dict()
+        for htmlfile in usedFnames:
+            targets[os.path.join(publichtmldir, os.path.relpath(htmlfile, os.path.join(os.getcwd(), self.rootdir)))] = htmlfile
+        for figfile in usedfigureFnames:
+            # keep the layout under images, since the downscaled copies live in images/variants
+            targets[os.path.join(publichtmlimagesdir, os.path.relpath(figfile, os.path.join(os.getcwd(), self.rootdir, 'images')))] = figfile
+        for target in targets.keys():
+            Path(os.path.dirname(target)).mkdir(parents=True, exist_ok=True)
+
+        # copies are mostly waiting on the disk, so threads are enough
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            copied = sum(executor.map(lambda target: syncfile(targets[target], target, False), targets.keys()))
+
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(publichtmldir):
+            for filename in filenames:
+                if os.path.join(dirpath, filename) not in targets.keys():
+                    os.remove(os.path.join(dirpath, filename))
+                    removed += 1
+        for dirpath, dirnames, filenames in os.walk(publichtmldir, topdown=False):
+            if dirpath != publichtmldir and dirpath != publichtmlimagesdir and len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
+
+        return {'directory': publichtmldir, 'copied': copied, 'unchanged': len(targets) - copied, 'removed': removed}
+
+    # -e --atomic, see stagefile
+    def exportgeneration(self, usedFnames, usedfigureFnames):
+        publichtmldir = os.path.join(os.getcwd(), self.rootdir, 'publichtml')
+        # a publichtml from before --atomic becomes the first generation. This is the only time readers can catch it missing, for a moment
+        if os.path.isdir(publichtmldir) and not os.path.islink(publichtmldir):
+            Path(publichtmldir + '-generations').mkdir(exist_ok=True)
+            os.rename(publichtmldir, os.path.join(publichtmldir + '-generations', str(len(generations(publichtmldir)) + 1)))
+            publishgeneration(publichtmldir, generations(publichtmldir)[-1])
+        previousdir = os.path.realpath(publichtmldir) if os.path.isdir(publichtmldir) else None
+        generationdir = os.path.join(publichtmldir + '-generations', str(int(os.path.basename(generations(publichtmldir)[-1])) + 1 if len(generations(publichtmldir)) > 0 else 1))
+        # left over from an export that didn't finish
+        shutil.rmtree(generationdir, ignore_errors=True)
+
+        targets = dict()
+        for htmlfile in usedFnames:
+            targets[os.path.relpath(htmlfile, os.path.join(os.getcwd(), self.rootdir))] = htmlfile
+        for figfile in usedfigureFnames:
+            targets[os.path.join('images', os.path.relpath(figfile, os.path.join(os.getcwd(), self.rootdir, 'images')))] = figfile
+        Path(os.path.join(generationdir, 'images')).mkdir(parents=True, exist_ok=True)
+        for target in targets.keys():
+            Path(os.path.dirname(os.path.join(generationdir, target))).mkdir(parents=True, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            copied = sum(executor.map(lambda target: stagefile(targets[target], os.path.join(generationdir, target), os.path.join(previousdir or generationdir, target)), targets.keys()))
+
+        removed = 0
+        if previousdir is not None:
+            for dirpath, dirnames, filenames in os.walk(previousdir):
+                removed += len([filename for filename in filenames if os.path.relpath(os.path.join(dirpath, filename), previousdir) not in targets.keys()])
+
+        # everything is in place, so switch over, and keep only the generation that was being served before
+        publishgeneration(publichtmldir, generationdir)
+        for olddir in generations(publichtmldir):
+            if os.path.realpath(olddir) not in [os.path.realpath(generationdir), previousdir]:
+                shutil.rmtree(olddir)
+
+        return {'directory': publichtmldir, 'copied': copied, 'unchanged': len(targets) - copied, 'removed': removed}
+
+    # write the search index from searchcache (fname : {'key', 'title', 'docs', 'terms'} for every page on the site). Only the shards in changedshards,
+    # the ones with words from pages that changed, are put together and written again, along with any that are missing. Returns every file of the index
+    def writesearchindex(self, searchcache, changedshards):
+        searchdir = os.path.join(os.getcwd(), self.rootdir, 'search')
+        Path(searchdir).mkdir(parents=True, exist_ok=True)
+        existing = set(os.listdir(searchdir))
+        allshards = set()
+        for fname in searchcache.keys():
+            allshards.update([searchshard(word) for word in searchcache[fname]['terms'].keys()])
+        towrite = set([shard for shard in allshards if shard in changedshards or shard + '.json' not in existing])
+
+        shards = {shard: dict() for shard in towrite} # shard : {word : [[page, document number, weight], ...]}
+        for fname in sorted(searchcache.keys()):
+            for word, postings in searchcache[fname]['terms'].items():
+                if searchshard(word) in towrite:
+                    if word not in shards[searchshard(word)].keys():
+                        shards[searchshard(word)][word] = []
+                    shards[searchshard(word)][word] += [[fname.split('.')[0], doc, weight] for doc, weight in postings]
+        for shard in shards.keys():
+            writeoutput(os.path.join(searchdir, shard + '.json'), json.dumps(shards[shard], sort_keys=True, separators=(',', ':')), False)
+
+        docs = {fname.split('.')[0]: {'title': searchcache[fname]['title'], 'docs': searchcache[fname]['docs']} for fname in sorted(searchcache.keys())}
+        writeoutput(os.path.join(searchdir, 'docs.json'), json.dumps(docs, separators=(',', ':')), False)
+
+        # and clean out shards that have no words left
+        searchFnames = [os.path.join(searchdir, shard + '.json') for shard in sorted(allshards)] + [os.path.join(searchdir, 'docs.json')]
+        keptFnames = set(searchFnames)
+        for entry in os.scandir(searchdir):
+            if not listedoutput(entry.path, keptFnames):
+                os.remove(entry.path)
+
+        searchhtml = '<html><head><title>' + self.sitetitle + ': Search</title><link rel="stylesheet" href="' + self.stylesheet + '"></head><body><div><p><a href=index.html>Table of Contents</a></p><h1>Search</h1>'
+        searchhtml += '<p><input type="search" autofocus oninput="search(this.value)" placeholder="Search ' + self.sitetitle + '"></p><div id="results"></div>' + searchscript
+        searchhtml += '<p class=texsite>This is a <a href="https://github.com/cdkocher/teXsite" target="_blank">teXsite</a>.</p></div></body></html>'
+        writeoutput(os.path.join(os.getcwd(), self.rootdir, 'search.html'), searchhtml, '--minify' in self.options)
+        return [os.path.join(os.getcwd(), self.rootdir, 'search.html')] + searchFnames
+
+    # the whole build, from reading index.txt to exporting. Returns a dict with what was rebuilt and why, the math cache hits and misses, the time
+    # spent in each phase, counters for each rendered page, and what the export did. Calling it again (like --watch does) reuses the warm caches
+    def build(self):
+        self.phasetimes.clear()
+        buildstart = clock()
+        # make images if it doesn't exist. 
+        mathdir = os.path.join(os.getcwd(),self.rootdir,"images")
+        Path(mathdir).mkdir(parents=True, exist_ok=True)
+
+        # load in index.txt toc into the compilerules dict, and pull the titles
+
+        # save filenames for the export
+        usedFnames = [os.path.join(os.getcwd(),self.rootdir,'index.html'),os.path.join(os.getcwd(),self.rootdir,'style.css')]
+
+        titlerules = dict()
+        compilerules = dict()
+        sitetitle = ''
+        siteauthor = ''
+        backtotext = ''
+        backtolink = ''
+        toclines = [] # what goes on index.html, in order: ['include', fname, chapter and title] or ['text', line]
+        start = clock()
+        with open(self.tocFname) as f:
+            for line in f:
+                # if \include is here, assign \include{key}{valcompilerules}{title}
+                # title rules maps fname (key) : valcompilerules title
+                nocommentsline = line.split('##')[0] # have to cut out commented out parts
+                if '\\include' in nocommentsline:
+                    compilerules[nocommentsline.split('}{')[0].split('{')[1]] = nocommentsline.split('}{')[1]
+                    titlerules[nocommentsline.split('}{')[0].split('{')[1]] = nocommentsline.split('}{')[1] + ' ' + nocommentsline.split('}{')[2].split('}')[0]
+                    usedFnames.append(os.path.join(os.getcwd(), self.rootdir, nocommentsline.split('}{')[0].split('{')[1].split('.')[0] + '.html'))
+                    toclines.append(['include', nocommentsline.split('}{')[0].split('{')[1], titlerules[nocommentsline.split('}{')[0].split('{')[1]]])
+
+                elif '\\title' not in nocommentsline and '\\author' not in nocommentsline and '\\backto' not in nocommentsline:
+                    toclines.append(['text', nocommentsline.strip()])
+
+                # find title and author
+                if '\\title' in nocommentsline:
+                    sitetitle = nocommentsline.split('{')[1].split('}')[0] # \title{...}
+
+                if '\\author' in nocommentsline:
+                    siteauthor = nocommentsline.split('{')[1].split('}')[0] # \author{...}
+
+                # find backto
+                if '\\backto' in nocommentsline:
+                    backtotext = nocommentsline.split('{')[1].split('}')[0] # \backto{backtotext}{backtolink}
+                    backtolink = nocommentsline.split('}{')[1].split('}')[0]
+        self.addtime('index parse', start)
+
+        # load the build manifest from last time, if there is one. It records hashes of every input and the labels each page exports, so we only re-render pages that changed
+        cachedir = os.path.join(os.getcwd(), self.rootdir, '.texsite')
+        manifestFname = os.path.join(cachedir, 'manifest.json')
+        oldmanifest = dict()
+        if os.path.exists(manifestFname) and '-f' not in self.options:
+            try:
+                with open(manifestFname) as file:
+                    oldmanifest = json.load(file)
+            except ValueError:
+                oldmanifest = dict() # corrupt manifest, just rebuild everything
+
+        if oldmanifest.get('version') != versionnumber:
+            oldmanifest = dict() # a different compiler version may render differently, so start over
+
+        oldpages = oldmanifest.get('pages', dict())
+        # --defer-math also needs its fold, since changing it changes the pages
+        self.mathfold = int(optionvalue(self.options, '--defer-math', foldcharacters)) if '--defer-math' in self.options else None
+        newmanifest = {'version': versionnumber, 'index': hashfile(self.tocFname), 'sitetitle': sitetitle, 'options': [option for option in renderoptions if option in self.options] + (['--defer-math ' + str(self.mathfold)] if self.mathfold is not None else []), 'pages': dict()}
+
+        # first, run through each file once, parse it into its document tree, and pull all the labels to make the map
+        start = clock()
+
+        mapping = dict()
+        linkmapping = dict() # for storing the hyperlink
+        tocompileFnames = list(compilerules.keys())
+        # with --page, every other page is left alone, and anything they define is looked up in the label index once the page is parsed
+        onlypage = optionvalue(self.options, '--page', '')
+        if onlypage != '':
+            if onlypage not in compilerules.keys():
+                raise TexsiteError('--page {} is not \\included in index.txt'.format(onlypage))
+            if not os.path.exists(os.path.join(cachedir, 'labels.sqlite')):
+                raise TexsiteError('--page needs the label index from a full build, run compilesite.py {} first'.format(self.rootdir))
+            tocompileFnames = [onlypage]
+        substructuremap = dict() # for storing sections and subsections
+        self.pagetrees = dict() # fname : document tree, so the html writer does not need to read or parse the page again
+        self.pagelinecounts = dict() # fname : lines in the source, for --profile. Counted while hashing, and kept in the manifest too
+        self.pageparts = dict() # fname : the html files it is written to
+        self.pagedefermath = dict() # fname : False if it has \nodefermath
+        streamabove = float(optionvalue(self.options, '--stream-above', 64)) * 1024 * 1024
+        # pages bigger than --split-above KB get an html file for each \section, so a long chapter isn't one huge page
+        splitabove = float(optionvalue(self.options, '--split-above', 'inf')) * 1024
+        for fname in tocompileFnames:
+            # first, initialize all counting indices
+            sections = 0
+            subsections = 0
+            #subsubsections = 0 # don't want this one, too small
+            figures = 0
+            equations = 0
+            tables = 0
+            # pages bigger than --stream-above MB are never held in memory whole, so they are hashed a line at a time and their nodes read from the file as needed
+            pageFname = os.path.join(os.getcwd(), self.rootdir, fname)
+            streamed = os.path.getsize(pageFname) > streamabove
+            if streamed:
+                pagehasher = hashlib.sha256()
+                self.pagelinecounts[fname] = 0
+                with open(pageFname) as file:
+                    for line in file:
+                        pagehasher.update(line.encode('utf-8'))
+                        self.pagelinecounts[fname] += 1
+                pagehash = pagehasher.hexdigest()
+            else:
+                with open(pageFname) as file:
+                    lines = list(file)
+                pagehash = hashstring(''.join(lines))
+                self.pagelinecounts[fname] = len(lines)
+
+            split = os.path.getsize(pageFname) > splitabove
+
+            # if the page, its chapter number and whether it is split are the same as last build, its labels cannot have changed, so take them from the manifest
+            oldpage = oldpages.get(fname, dict())
+            if oldpage.get('hash') == pagehash and oldpage.get('chapter') == compilerules[fname] and oldpage.get('split') == split:
+                for label in oldpage['labels'].keys():
+                    mapping[label] = oldpage['labels'][label][0]
+                    linkmapping[label] = oldpage['labels'][label][1]
+                substructuremap[fname] = oldpage['substructure']
+                newmanifest['pages'][fname] = {'hash': pagehash, 'chapter': compilerules[fname], 'title': titlerules[fname], 'labels': oldpage['labels'], 'substructure': oldpage['substructure'], 'refs': list(oldpage['refs'].keys()), 'bib': oldpage['bib'], 'figures': oldpage['figures'], 'datafiles': oldpage.get('datafiles', []), 'split': split, 'parts': oldpage['parts'], 'defermath': oldpage.get('defermath', True), 'lines': self.pagelinecounts[fname]}
+                continue
+
+            if not streamed:
+                self.pagetrees[fname] = parsepage(lines, fname)
+                del lines
+
+            substructuremap[fname] = list() # to add the substructure lines to
+            pagelabels = list() # labels this page exports, for the manifest
+            pagerefs = list() # labels this page refers to, so we know to rebuild it if they get renumbered
+            pagebibfname = ''
+            pagefigureFnames = []
+            pagedataFnames = []
+            pagedefermath = True
+            pageparts = [fname.split('.')[0] + '.html'] # a split page's html files. The first also has everything before the first \section
+            for node in self.pagenodes(fname):
+                # check for each thing. then pull label, determine number, add to mapping
+                label = ''
+                if node['type'] == 'bibliography':
+                    # treat it as a section
+                    sectionname = 'References'
+                    label = fname + '-references'
+                    sections += 1
+                    mapping[label] = compilerules[fname] + '.' + str(sections)
+                    # start over on subsections and subsubsections
+                    subsections = 0
+                    if pagebibfname == '':
+                        pagebibfname = node['file']
+
+                elif node['type'] == 'section':
+                    # add a section
+                    sectionname = node['heading']
+                    label = node['label']
+                    # increment sections
+                    sections += 1
+                    if split and sections > 1:
+                        pageparts.append(fname.split('.')[0] + '-' + str(len(pageparts) + 1) + '.html')
+                    mapping[label] = compilerules[fname] + '.' + str(sections)
+                    # start over on subsections and subsubsections
+                    subsections = 0
+
+                elif node['type'] == 'subsection':
+                    # add a subsection
+                    sectionname = node['heading']
+                    label = node['label']
+                    # increment subsections
+                    subsections += 1
+                    mapping[label] = compilerules[fname] + '.' + str(sections) + '.' + str(subsections)
+
+                elif node['type'] == 'figure':
+                    # add a figure
+                    label = node['label']
+                    pagefigureFnames.append(node['file'])
+                    figures += 1
+                    mapping[label] = compilerules[fname] + '.' + str(figures)
+
+                elif node['type'] == 'table':
+                    # add a table
+                    label = node['label']
+                    if node['data'] != '':
+                        pagedataFnames.append(node['data'])
+                    tables += 1
+                    mapping[label] = compilerules[fname] + '.' + str(tables)
+
+                elif node['type'] == 'nodefermath':
+                    pagedefermath = False
+
+                elif node['type'] == 'equation': # here we only give a single equation number to an align..... is that ok?
+                    # add an equation
+                    label = node['label']
+                    equations += 1
+                    mapping[label] = compilerules[fname] + '.' + str(equations)
+
+                if label != '':
+                    #linkmapping[label] = '/' + fname + '#' + label
+                    linkmapping[label] = pageparts[-1] + '#' + label
+                    pagelabels.append(label)
+
+                # add substructure line for printing on TOC
+                if node['type'] in ['bibliography', 'section']:
+                    substructuremap[fname].append('<h3><pre>   <a href="' + linkmapping[label] + '">' + mapping[label] + ' ' + sectionname + '</a></pre></h3>')
+                elif node['type'] == 'subsection':
+                    substructuremap[fname].append('<h4><pre>            <a href="' + linkmapping[label] + '">' + mapping[label] + ' ' + sectionname + '</a></pre></h4>')
+
+                # keep track of what this page refers to, for deciding whether to rebuild it next time
+                for kind, value in nodetokens(node):
+                    if kind == 'ref':
+                        pagerefs.append(value)
+
+            # save what we learned in the new manifest. refs are filled in with their numbers once the map is done
+            newmanifest['pages'][fname] = {'hash': pagehash, 'chapter': compilerules[fname], 'title': titlerules[fname], 'labels': {label: [mapping[label], linkmapping[label]] for label in pagelabels}, 'substructure': substructuremap[fname], 'refs': pagerefs, 'bib': pagebibfname, 'figures': pagefigureFnames, 'datafiles': pagedataFnames, 'split': split, 'parts': pageparts, 'defermath': pagedefermath, 'lines': self.pagelinecounts[fname]}
+
+
+        # and that should conclude the map. We do store it in the manifest, so unchanged pages can skip this next time
+        for fname in tocompileFnames:
+            self.pageparts[fname] = newmanifest['pages'][fname]['parts']
+            self.pagedefermath[fname] = newmanifest['pages'][fname]['defermath']
+            usedFnames += [os.path.join(os.getcwd(), self.rootdir, part) for part in self.pageparts[fname][1:]]
+
+        # may want to add compilerules so we can reference pages themselves, not just sections.
+
+        for page in compilerules.keys():
+            mapping[page] = compilerules[page]
+            #linkmapping[page] = '/' + page.split('.')[0] + '.html'
+            linkmapping[page] = page.split('.')[0] + '.html'
+
+        # bring the label index up to date with the pages that changed, or with --page, fill in what the page refers to from it
+        labelindex = openlabelindex(cachedir)
+        if onlypage != '':
+            for label, value in lookuplabels(labelindex, [label for label in newmanifest['pages'][onlypage]['refs'] if label not in mapping.keys()]).items():
+                mapping[label] = value[0]
+                linkmapping[label] = value[1]
+            # and the toc lines of the other pages, so index.html can be written again
+            for fname, substructure in labelindex.execute('SELECT page, substructure FROM pages').fetchall():
+                if fname != onlypage:
+                    substructuremap[fname] = json.loads(substructure)
+            for fname in compilerules.keys():
+                if fname not in substructuremap.keys():
+                    substructuremap[fname] = []
+        if '--dry-run' not in self.options:
+            for fname in tocompileFnames:
+                page = newmanifest['pages'][fname]
+                updatelabelindex(labelindex, fname, versionnumber + ':' + page['chapter'] + ':' + page['hash'] + ':' + str(page['split']), page['labels'], page['substructure'])
+            if onlypage == '':
+                removedFnames = [row for row in labelindex.execute('SELECT page FROM pages').fetchall() if row[0] not in compilerules.keys()]
+                labelindex.executemany('DELETE FROM labels WHERE page = ?', removedFnames)
+                labelindex.executemany('DELETE FROM pages WHERE page = ?', removedFnames)
+            labelindex.commit()
+        labelindex.close()
+        self.addtime('label pass', start)
+
+        #print(mapping)
+
+        # look up each figure's size and content hash, reusing what we found last time if the file hasn't been touched since
+        start = clock()
+        imagesdir = os.path.join(os.getcwd(), self.rootdir, 'images')
+        imagecacheFname = os.path.join(cachedir, 'images.json')
+        oldimageinfo = dict()
+        if os.path.exists(imagecacheFname):
+            try:
+                with open(imagecacheFname) as file:
+                    oldimageinfo = json.load(file)
+            except ValueError:
+                oldimageinfo = dict() # corrupt cache, just look at every image again
+
+        imageinfo = dict() # figure fname : {'mtime', 'size', 'hash', 'width', 'height'}
+        for fname in tocompileFnames:
+            for figureFname in newmanifest['pages'][fname]['figures']:
+                figurepath = os.path.join(imagesdir, figureFname)
+                if figureFname in imageinfo.keys() or not os.path.isfile(figurepath):
+                    continue
+                figurestat = os.stat(figurepath)
+                oldinfo = oldimageinfo.get(figureFname, dict())
+                if oldinfo.get('mtime') == figurestat.st_mtime_ns and oldinfo.get('size') == figurestat.st_size:
+                    imageinfo[figureFname] = oldinfo
+                    continue
+                dimensions = imagedimensions(figurepath)
+                imageinfo[figureFname] = {'mtime': figurestat.st_mtime_ns, 'size': figurestat.st_size, 'hash': hashfile(figurepath), 'width': dimensions[0] if dimensions else None, 'height': dimensions[1] if dimensions else None}
+        self.addtime('images', start)
+
+        # with --search, the words of every page are kept in .texsite/search.json, so only the pages being rendered have to be indexed again
+        searchcacheFname = os.path.join(cachedir, 'search.json')
+        searchcache = dict() # fname : {'key', 'title', 'docs', 'terms'}
+        searchkeys = dict() # fname : what its entry depends on, to tell if it is still good
+        if '--search' in self.options and os.path.exists(searchcacheFname):
+            try:
+                with open(searchcacheFname) as file:
+                    searchcache = json.load(file)
+            except ValueError:
+                searchcache = dict() # corrupt cache, just index every page again
+
+        # now decide which pages actually need to be rendered again. A page is rebuilt if its source, title, bib file or images changed, if its html is missing, or if anything it \\refs got a new number or link
+        bibhashes = dict() # bib fname : hash, so we only hash each bib file once
+        self.datahashes = dict() # data file : hash, '' if it is missing
+        rebuildFnames = []
+        reasons = dict() # fname : why it is being rebuilt, or '' if it is up to date
+        for fname in tocompileFnames:
+            page = newmanifest['pages'][fname]
+            page['refs'] = {label: [mapping.get(label), linkmapping.get(label)] for label in page['refs']}
+            if page['bib'] != '':
+                bibfname = os.path.join(os.getcwd(), self.rootdir, page['bib'])
+                if bibfname not in bibhashes.keys():
+                    bibhashes[bibfname] = hashfile(bibfname) if os.path.exists(bibfname) else ''
+                page['bibhash'] = bibhashes[bibfname]
+            else:
+                page['bibhash'] = ''
+            for dataFname in page['datafiles']:
+                if dataFname not in self.datahashes.keys():
+                    self.datahashes[dataFname] = hashfile(os.path.join(os.getcwd(), self.rootdir, dataFname)) if os.path.isfile(os.path.join(os.getcwd(), self.rootdir, dataFname)) else ''
+            page['data'] = {dataFname: self.datahashes[dataFname] for dataFname in page['datafiles']}
+            page['tables'] = oldpages.get(fname, dict()).get('tables', [])
+            page['matherrors'] = oldpages.get(fname, dict()).get('matherrors', [])
+            searchkeys[fname] = versionnumber + ':' + page['chapter'] + ':' + page['title'] + ':' + page['hash'] + ':' + page['bibhash']
+            # the image hash goes into the variant names, and the variant widths into srcset
+            page['images'] = {figureFname: imageinfo[figureFname]['hash'] + ':' + str(imagevariants(figureFname, imageinfo)) if figureFname in imageinfo.keys() else '' for figureFname in page['figures']}
+
+            oldpage = oldpages.get(fname)
+            reason = ''
+            if onlypage != '':
+                reason = 'asked for with --page'
+            elif oldpage is None:
+                reason = 'new page'
+            elif oldpage['hash'] != page['hash']:
+                reason = 'source changed'
+            elif oldpage['title'] != page['title'] or oldmanifest.get('sitetitle') != sitetitle:
+                reason = 'title changed in index.txt'
+            elif oldmanifest.get('options') != newmanifest['options']:
+                reason = 'output options changed'
+            elif oldpage['labels'] != page['labels']:
+                reason = 'numbering changed'
+            elif oldpage['bibhash'] != page['bibhash']:
+                reason = page['bib'] + ' changed'
+            elif oldpage.get('images') != page['images']:
+                reason = 'image changed'
+            elif oldpage.get('data') != page['data']:
+                reason = 'data file changed'
+            elif any([matherror.get('transient', True) for matherror in oldpage.get('matherrors', [])]) and '--watch' not in self.options:
+                reason = 'math failed last build'
+            elif any([not os.path.exists(os.path.join(os.getcwd(), self.rootdir, part)) for part in page['parts']]):
+                reason = 'html output missing'
+            elif '--search' in self.options and searchcache.get(fname, dict()).get('key') != searchkeys[fname]:
+                reason = 'not in the search index'
+            else:
+                for label in page['refs'].keys():
+                    if page['refs'][label] != oldpage['refs'].get(label):
+                        reason = 'target of \\ref{' + label + '} changed'
+                        break
+
+            if reason != '':
+                rebuildFnames.append(fname)
+            reasons[fname] = reason
+
+        results = {'rootdir': self.rootdir, 'version': versionnumber, 'pages': len(tocompileFnames), 'reasons': reasons, 'rendered': rebuildFnames, 'mathcache': self.mathcachestats,
+                   'phases': dict(), 'pagecounters': dict(), 'export': None}
+        if '--dry-run' in self.options:
+            return results
+
+        # merge the site's math cache in, unless it already was by an earlier build in this process. It is thrown out if latex2mathml has been upgraded, since the output might be different now
+        mathcacheFname = os.path.join(cachedir, 'mathcache.json')
+        self.mathcachesize = int(optionvalue(self.options, '--math-cache-size', self.mathcachesize))
+        self.mathtimeout = float(optionvalue(self.options, '--math-timeout', self.mathtimeout))
+        self.mathmemory = int(optionvalue(self.options, '--math-memory', self.mathmemory))
+        self.matherrors = []
+        self.mathcachestats['hits'] = 0
+        self.mathcachestats['misses'] = 0
+        self.mathcachestats['fast'] = 0
+        latex2mathmlversion = metadata.version('latex2mathml')
+        self.latex2mathmlversion = latex2mathmlversion
+        if mathcacheFname not in sitemathkeys.keys() and self.mathcachesize > 0:
+            sitemathkeys[mathcacheFname] = OrderedDict()
+            if os.path.exists(mathcacheFname):
+                try:
+                    with open(mathcacheFname) as file:
+                        storedmathcache = json.load(file)
+                    if storedmathcache['latex2mathml'] == latex2mathmlversion:
+                        # entries are stored oldest first, keep only the newest ones if the cap went down. What other sites have is already newer
+                        for key, mathml in reversed(storedmathcache['entries'][-self.mathcachesize:]):
+                            if key not in self.mathcache:
+                                self.mathcache[key] = mathml
+                                self.mathcache.move_to_end(key, last=False)
+                        for key, mathml in storedmathcache['entries'][-self.mathcachesize:]:
+                            sitemathkeys[mathcacheFname][key] = True
+                except (ValueError, KeyError):
+                    sitemathkeys[mathcacheFname].clear() # corrupt cache, just start over
+        self.mathkeys = sitemathkeys.get(mathcacheFname, OrderedDict())
+
+        # make any downscaled copies of the figures that don't exist yet. Resizing is slow, so spread it over every core.
+        # Inside a buildsites worker there can't be another pool, so everything there is done in one process
+        numjobs = int(optionvalue(self.options, '-j', 1))
+        if numjobs == 0:
+            numjobs = os.cpu_count()
+        if multiprocessing.current_process().daemon:
+            numjobs = 1
+        # the cores are shared out between the processes rendering pages, and each of them has its own math workers
+        self.mathworkers = int(optionvalue(self.options, '--math-workers', max(2, min(4, os.cpu_count() // numjobs))))
+
+        start = clock()
+        variantsdir = os.path.join(imagesdir, 'variants')
+        variantjobs = []
+        variantFnames = [] # every copy in use, for exporting
+        for figureFname in imageinfo.keys():
+            for width in imagevariants(figureFname, imageinfo):
+                variantFnames.append(os.path.join(imagesdir, variantname(figureFname, width, imageinfo)))
+                if not os.path.exists(variantFnames[-1]):
+                    variantjobs.append((os.path.join(imagesdir, figureFname), variantFnames[-1], width))
+
+        if len(variantjobs) > 0:
+            Path(variantsdir).mkdir(parents=True, exist_ok=True)
+            if len(variantjobs) > 1 and multiprocessing.current_process().daemon == False and 'fork' in multiprocessing.get_all_start_methods():
+                with multiprocessing.get_context('fork').Pool() as pool:
+                    pool.map(makevariant, variantjobs)
+            else:
+                for variantjob in variantjobs:
+                    makevariant(variantjob)
+
+        # and clean out copies of images that changed or are no longer used. With --page we only know about that page's images, so leave them be
+        if os.path.isdir(variantsdir) and onlypage == '':
+            wantedvariants = set(variantFnames)
+            for entry in os.scandir(variantsdir):
+                if entry.path not in wantedvariants:
+                    os.remove(entry.path)
+
+        # with --fingerprint, link every image to its name with the content hash in it. Unchanged images are already linked, so nothing is written for them
+        hasheddir = os.path.join(imagesdir, 'hashed')
+        fingerprintFnames = []
+        if '--fingerprint' in self.options:
+            for figureFname in imageinfo.keys():
+                fingerprintFnames.append(os.path.join(imagesdir, fingerprintname(figureFname, imageinfo)))
+                Path(os.path.dirname(fingerprintFnames[-1])).mkdir(parents=True, exist_ok=True)
+                syncfile(os.path.join(imagesdir, figureFname), fingerprintFnames[-1], True)
+        if os.path.isdir(hasheddir) and onlypage == '':
+            wantedfingerprints = set(fingerprintFnames)
+            for dirpath, dirnames, filenames in os.walk(hasheddir):
+                for filename in filenames:
+                    if os.path.join(dirpath, filename) not in wantedfingerprints:
+                        os.remove(os.path.join(dirpath, filename))
+        self.addtime('images', start)
+
+        # next, we go through each file and make our replacements, then write it to an html file
+
+        # pages being rebuilt only because something they reference changed got their labels from the manifest, so they still need parsing
+        start = clock()
+        for fname in rebuildFnames:
+            pageFname = os.path.join(os.getcwd(), self.rootdir, fname)
+            if fname not in self.pagetrees.keys() and os.path.getsize(pageFname) <= streamabove:
+                with open(pageFname) as file:
+                    lines = list(file)
+                self.pagetrees[fname] = parsepage(lines, fname)
+        self.addtime('label pass', start)
+
+        # now the bibliographies. Each version of a bib file is indexed once, only the entries that are cited are read out of it and parsed, and formatted entries
+        # are cached between builds by bib file hash, style and key. All the keys cited in a style are formatted together in one batch, and on a warm build nothing
+        # has to be parsed or formatted at all
+        start = clock()
+        bibcacheFname = os.path.join(cachedir, 'bibcache.json')
+        bibcache = dict() # bib hash : {'styles': {style: {lowercase key: html}}}
+        if os.path.exists(bibcacheFname):
+            try:
+                with open(bibcacheFname) as file:
+                    bibcache = json.load(file)
+            except ValueError:
+                bibcache = dict() # corrupt cache, just start over
+
+        pagebibs = dict() # fname : [bib hash, style] for pages being rendered that have a bibliography
+        bibfiles = dict() # bib hash : bib fname
+        citedkeys = dict() # (bib hash, style) : keys cited with it
+        for fname in rebuildFnames:
+            bibfname = os.path.join(os.getcwd(), self.rootdir, newmanifest['pages'][fname]['bib'])
+            if newmanifest['pages'][fname]['bib'] == '' or not os.path.exists(bibfname):
+                continue
+            # one walk through the page for the style of its (first) bibliography and everything it cites
+            bibstyle = None
+            pagecitedkeys = set()
+            for node in self.pagenodes(fname):
+                if node['type'] == 'bibliography' and bibstyle is None:
+                    bibstyle = node['style']
+                for kind, value in nodetokens(node):
+                    if kind == 'cite':
+                        pagecitedkeys.update([key.lower() for key in value])
+            bibhash = newmanifest['pages'][fname]['bibhash']
+            pagebibs[fname] = [bibhash, bibstyle]
+            bibfiles[bibhash] = bibfname
+            if (bibhash, bibstyle) not in citedkeys.keys():
+                citedkeys[(bibhash, bibstyle)] = set()
+            citedkeys[(bibhash, bibstyle)].update(pagecitedkeys)
+
+        # which of the cited keys are in their bib file comes from the index, so the rest of the file is never looked at
+        bibindex = openbibindex(cachedir)
+        bibkeys = dict() # bib hash : cited keys that are in the file
+        for bibhash in bibfiles.keys():
+            indexbibfile(bibindex, bibhash, bibfiles[bibhash])
+            cited = set()
+            for pair in citedkeys.keys():
+                if pair[0] == bibhash:
+                    cited.update(citedkeys[pair])
+            bibkeys[bibhash] = set(lookupbibkeys(bibindex, bibhash, cited).keys())
+            if bibhash not in bibcache.keys():
+                bibcache[bibhash] = {'styles': dict()}
+
+        htmlbackend = None
+        for bibhash, bibstyle in citedkeys.keys():
+            if bibstyle not in bibcache[bibhash]['styles'].keys():
+                bibcache[bibhash]['styles'][bibstyle] = dict()
+            formatted = bibcache[bibhash]['styles'][bibstyle]
+            missing = sorted([key for key in citedkeys[(bibhash, bibstyle)] if key in bibkeys[bibhash] and key not in formatted.keys()])
+            if len(missing) > 0:
+                from pybtex.plugin import find_plugin
+                if htmlbackend is None:
+                    htmlbackend = find_plugin('pybtex.backends', 'html')()
+                for entry in find_plugin('pybtex.style.formatting', bibstyle)().format_bibliography(readbibentries(bibindex, bibhash, bibfiles[bibhash], missing), citations=missing):
+                    formatted[entry.key.lower()] = entry.text.render(htmlbackend)
+        self.addtime('bibliography formatting', start)
+
+        # make stylesheet: 
+        start = clock()
+        csstowrite = "div{max-width: 1000px; position: absolute; left: 50%; transform: translate(-50%,0); text-align: justify;}\n"
+        csstowrite += "math{font-size: 20px}\n"
+        csstowrite += "figcaption math{font-size: 16px}\n"
+        csstowrite += 'p{text-align: justify; font-size: 20px; line-height: 1.5}\n'
+        csstowrite += '.texsite{text-align: justify; font-size: 13px; color: gray;}\n'
+        csstowrite += 'h1{font-size: 38px}\n'
+        csstowrite += 'h2{font-size: 30px}\n'
+        csstowrite += 'h3{font-size: 25px}\n'
+        csstowrite += 'figcaption{text-align: justify; padding-top: 5px;}\n'
+        csstowrite += 'figure{text-align: center;}\n'
+        csstowrite += 'img{height: auto;}\n'
+        csstowrite += 'table{text-align: center; border: 1px solid #ddd; font-size: 18px;  margin-left: auto; margin-right: auto;}\n'
+        csstowrite += 'td{text-align: center; border: 1px solid #ddd;}\n'
+        csstowrite += 'th{text-align: center; border: 1px solid #ddd;}\n'
+        # with --fingerprint it is named by its content hash, and the old ones are taken out
+        self.stylesheet = 'style.css'
+        if '--fingerprint' in self.options:
+            self.stylesheet = 'style.' + hashstring(minifycss(csstowrite) if '--minify' in self.options else csstowrite)[:12] + '.css'
+        writeoutput(os.path.join(os.getcwd(), self.rootdir, self.stylesheet), csstowrite, '--minify' in self.options)
+        for entry in os.scandir(os.path.join(os.getcwd(), self.rootdir)):
+            if re.fullmatch(r'style\.[0-9a-f]{12}\.css(\.gz|\.zst)?', entry.name) and not entry.name.startswith(self.stylesheet):
+                os.remove(entry.path)
+        usedFnames[usedFnames.index(os.path.join(os.getcwd(), self.rootdir, 'style.css'))] = os.path.join(os.getcwd(), self.rootdir, self.stylesheet)
+        self.addtime('stylesheet/toc', start)
+
+
+        # everything the page writer needs from the passes above
+        self.titlerules = titlerules
+        self.sitetitle = sitetitle
+        self.mapping = mapping
+        self.linkmapping = linkmapping
+        self.pagebibs = pagebibs
+        self.bibcache = bibcache
+        self.bibkeys = bibkeys
+        self.imageinfo = imageinfo
+
+        # render with a pool of processes if asked to. Forking shares the site with the workers without copying it up front; without fork, just render serially
+        start = clock()
+
+        if numjobs > 1 and len(rebuildFnames) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            global forkedsite
+            forkedsite = self
+            with multiprocessing.get_context('fork').Pool(min(numjobs, len(rebuildFnames))) as pool:
+                pageresults = pool.map(renderforked, rebuildFnames, chunksize=1)
+            forkedsite = None
+            for pageresult in pageresults:
+                for key, mathml in pageresult['mathcache']:
+                    self.cachemath(key, mathml)
+                self.mathcachestats['hits'] += pageresult['hits']
+                self.mathcachestats['misses'] += pageresult['misses']
+                self.mathcachestats['fast'] += pageresult['fast']
+                self.matherrors += pageresult['matherrors']
+                self.mathfailures.update({matherror['display'] + ':' + matherror['latex']: matherror['error'] for matherror in pageresult['matherrors'] if matherror['transient']})
+                for phase in pageresult['phasetimes'].keys():
+                    if phase not in self.phasetimes.keys():
+                        self.phasetimes[phase] = [0.0, 0.0]
+                    self.phasetimes[phase][0] += pageresult['phasetimes'][phase][0]
+                    self.phasetimes[phase][1] += pageresult['phasetimes'][phase][1]
         else:
-            # put it between <p> </p>
-            newline = '<p>' + newline.strip() + '</p>\n'
-            
-        tochtml += newline
-        
-tochtml += '<p class=texsite>This is a <a href="https://github.com/cdkocher/teXsite" target="_blank">teXsite</a>.</p></div></body></html>'
-toctowrite = ''.join(tochtml)
-with open(os.path.join(os.getcwd(), rootdir,'index.html'), 'w') as file:
-    file.write(toctowrite)
-
-# if -e, copy stuff to publichtml
-if '-e' in sys.argv:
-    # if publichtml exists, delete it
-    publichtmldir = os.path.join(os.getcwd(), rootdir, 'publichtml')
-    if os.path.exists(publichtmldir):
-        # delete it
-        shutil.rmtree(publichtmldir)
-    
-    # add publichtml and images dir
-    publichtmlimagesdir = os.path.join(os.getcwd(), rootdir, 'publichtml', 'images')
-    Path(publichtmlimagesdir).mkdir(parents=True, exist_ok=True)
-    # copy files
-    for htmlfile in usedFnames:
-        shutil.copy(htmlfile,publichtmldir)
-        
-    for figfile in usedfigureFnames:
-        shutil.copy(figfile,publichtmlimagesdir)
-        
+            pageresults = [self.renderpage(fname) for fname in rebuildFnames]
+        # a page that is now split into fewer parts, or not at all, leaves the old parts behind
+        for fname, pageresult in zip(rebuildFnames, pageresults):
+            newmanifest['pages'][fname]['tables'] = pageresult['tables']
+            newmanifest['pages'][fname]['matherrors'] = pageresult['matherrors']
+            for part in oldpages.get(fname, dict()).get('parts', []):
+                if part not in self.pageparts[fname] and os.path.exists(os.path.join(os.getcwd(), self.rootdir, part)):
+                    os.remove(os.path.join(os.getcwd(), self.rootdir, part))
+        self.addtime('render', start)
+
+        usedfigureFnames = [] # keep these for copying later with -e flag if necessary
+        for fname in tocompileFnames:
+            usedfigureFnames += [os.path.join(os.getcwd(), self.rootdir, 'images', figureFname) for figureFname in newmanifest['pages'][fname]['figures'] if figureFname not in imageinfo.keys() or '--fingerprint' not in self.options]
+        usedfigureFnames += variantFnames + fingerprintFnames
+
+        start = clock()
+        # make TOC page with substructure
+        tochtml = '<html><head><title>' + sitetitle + '</title><link rel="stylesheet" href="' + self.stylesheet + '"></head><body><div>'
+        # if we have a backto command, then we need to put the link at the top
+        if backtotext != '' and backtolink != '':
+            tochtml += '<p><a href="' + backtolink + '">Back to ' + backtotext + '</a></p>'
+        tochtml += '<h1>' + sitetitle + '</h1><p>By: ' + siteauthor + '</p>'
+        if '--search' in self.options:
+            tochtml += '<p><a href=search.html>Search</a></p>'
+        tochtml += '<h2>Table of Contents</h2>'
+        # with --toc-chapters, index.html only lists the chapters, and the sections and subsections of each are in toc/(page).html, which is loaded when the chapter is opened
+        tocdir = os.path.join(os.getcwd(), self.rootdir, 'toc')
+        tocFnames = []
+        for tocline in toclines:
+            if tocline[0] == 'include':
+                # make a link, and add the substructure
+                newline = "<h2><a href='" + tocline[1].split('.')[0] + '.html' + "'>" + tocline[2] + "</a></h2>"
+                if '--toc-chapters' not in self.options:
+                    newline += ''.join(substructuremap[tocline[1]])
+                elif len(substructuremap[tocline[1]]) > 0:
+                    Path(tocdir).mkdir(parents=True, exist_ok=True)
+                    tocFnames.append(os.path.join(tocdir, tocline[1].split('.')[0] + '.html'))
+                    writeoutput(tocFnames[-1], ''.join(substructuremap[tocline[1]]), '--minify' in self.options)
+                    newline += "<details data-toc='toc/" + tocline[1].split('.')[0] + ".html'><summary>Sections</summary></details>"
+
+            else:
+                # put it between <p> </p>
+                newline = '<p>' + tocline[1] + '</p>\n'
+
+            tochtml += newline
+
+        if len(tocFnames) > 0:
+            tochtml += tocscript
+        tochtml += '<p class=texsite>This is a <a href="https://github.com/cdkocher/teXsite" target="_blank">teXsite</a>.</p></div></body></html>'
+        toctowrite = ''.join(tochtml)
+        writeoutput(os.path.join(os.getcwd(), self.rootdir,'index.html'), toctowrite, '--minify' in self.options)
+        usedFnames += tocFnames
+        # and take out the sections of chapters that are gone, or all of them without --toc-chapters
+        if os.path.isdir(tocdir):
+            keptFnames = set(tocFnames)
+            for entry in os.scandir(tocdir):
+                if not listedoutput(entry.path, keptFnames):
+                    os.remove(entry.path)
+            if len(tocFnames) == 0:
+                os.rmdir(tocdir)
+        self.addtime('stylesheet/toc', start)
+        start = clock()
+
+        # everything is written, so save the manifest for next time. With --page, the other pages keep what they had, unless the options changed, in which case they will be rebuilt next time
+        if onlypage != '':
+            if oldmanifest.get('options') == newmanifest['options']:
+                newmanifest['pages'] = {fname: oldpages[fname] for fname in compilerules.keys() if fname in oldpages.keys() and fname != onlypage} | newmanifest['pages']
+            imageinfo = oldimageinfo | imageinfo
+            bibhashes = {bibhash: bibhash for bibhash in bibcache.keys()}
+            usedFnames = [os.path.join(os.getcwd(), self.rootdir, 'index.html'), os.path.join(os.getcwd(), self.rootdir, self.stylesheet)] + [os.path.join(os.getcwd(), self.rootdir, part) for part in self.pageparts[onlypage]] + tocFnames
+
+        Path(cachedir).mkdir(parents=True, exist_ok=True)
+        with open(manifestFname, 'w') as file:
+            json.dump(newmanifest, file)
+
+        # rendered data tables that no page uses anymore
+        tablesdir = os.path.join(cachedir, 'tables')
+        if os.path.isdir(tablesdir) and onlypage == '':
+            usedfragments = set([fragment for fname in newmanifest['pages'].keys() for fragment in newmanifest['pages'][fname]['tables']])
+            for entry in os.scandir(tablesdir):
+                if entry.name not in usedfragments:
+                    os.remove(entry.path)
+
+        with open(imagecacheFname, 'w') as file:
+            json.dump(imageinfo, file)
+
+        # only keep cached bibliographies and indexes for bib files that are still in use
+        with open(bibcacheFname, 'w') as file:
+            json.dump({bibhash: {'styles': bibcache[bibhash]['styles']} for bibhash in bibcache.keys() if bibhash in bibhashes.values()}, file)
+        prunebibindex(bibindex, set(bibhashes.values()))
+        bibindex.close()
+
+        if self.mathcachesize > 0:
+            with open(mathcacheFname, 'w') as file:
+                json.dump({'latex2mathml': latex2mathmlversion, 'entries': [[key, self.mathcache[key]] for key in self.mathkeys.keys() if key in self.mathcache]}, file)
+
+        self.addtime('cache save', start)
+
+        # bring the search index up to date with the pages that were rendered. With --page the other pages are left in it, since they are still on the site
+        if '--search' in self.options:
+            start = clock()
+            changedshards = set()
+            for fname, pageresult in zip(rebuildFnames, pageresults):
+                if fname in searchcache.keys():
+                    changedshards.update([searchshard(word) for word in searchcache[fname]['terms'].keys()])
+                changedshards.update([searchshard(word) for word in pageresult['search']['terms'].keys()])
+                searchcache[fname] = {'key': searchkeys[fname], 'title': titlerules[fname], 'docs': pageresult['search']['docs'], 'terms': pageresult['search']['terms']}
+            if onlypage == '':
+                for fname in list(searchcache.keys()):
+                    if fname not in compilerules.keys():
+                        changedshards.update([searchshard(word) for word in searchcache[fname]['terms'].keys()])
+                        del searchcache[fname]
+            usedFnames += self.writesearchindex(searchcache, changedshards)
+            with open(searchcacheFname, 'w') as file:
+                json.dump(searchcache, file)
+            self.addtime('search index', start)
+
+        # the cache headers, for everything that gets published. Not with --page, since that only knows about one page
+        headersFname = None
+        if '--fingerprint' in self.options and onlypage == '':
+            start = clock()
+            headersFname = os.path.join(os.getcwd(), self.rootdir, '_headers')
+            headers = {'/': shortcache}
+            for publishedFname in usedFnames + usedfigureFnames:
+                path = '/' + os.path.relpath(publishedFname, os.path.join(os.getcwd(), self.rootdir)).replace(os.sep, '/')
+                headers[path] = immutablecache if path == '/' + self.stylesheet or path.startswith('/images/hashed/') or path.startswith('/images/variants/') else shortcache
+            headerstowrite = '# cache headers for every published file, written by compilesite.py --fingerprint\n'
+            headerstowrite += ''.join([path + '\n  Cache-Control: ' + headers[path] + '\n' for path in sorted(headers.keys())])
+            writeoutput(headersFname, headerstowrite, False)
+            self.addtime('headers', start)
+
+        # precompressed copies for servers that can send them directly. Compressing releases the GIL, so threads run it in parallel
+        if '--compress' in self.options:
+            start = clock()
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(compressoutput, usedFnames))
+            usedFnames += [htmlfile + extension for htmlfile in list(usedFnames) for extension in compressors.keys()]
+            self.addtime('compress', start)
+        if headersFname is not None:
+            usedFnames.append(headersFname)
+
+        # if -e, sync stuff into publichtml. Only changed files are copied, so unchanged ones keep their mtimes for rsync and CDN syncing.
+        # Not with --page though, since the export would take everything else out of publichtml
+        if '-e' in self.options and onlypage == '':
+            start = clock()
+            results['export'] = self.exportsite(usedFnames, usedfigureFnames)
+            self.addtime('export', start)
+
+        # where the time went, for --profile and benchmarksite.py
+        self.addtime('total', buildstart)
+        results['jobs'] = numjobs
+        # and the math that couldn't be converted on pages that didn't need rendering, since it is still on them
+        results['matherrors'] = [matherror for fname in tocompileFnames if fname not in rebuildFnames for matherror in newmanifest['pages'][fname].get('matherrors', [])] + self.matherrors
+        results['phases'] = {phase: {'wall': self.phasetimes[phase][0], 'cpu': self.phasetimes[phase][1]} for phase in self.phasetimes.keys()}
+        results['pagecounters'] = {fname: pageresult['counters'] for fname, pageresult in zip(rebuildFnames, pageresults)}
+        return results
+
+# forked worker processes render pages of the site being built, which they inherit from the parent when they are forked
+forkedsite = None
+def renderforked(fname):
+    return forkedsite.renderpage(fname)
+
+# build many sites in one process, like for nightly CI. Each worker process builds its share of the sites one after another, so the imports
+# and the math cache only have to warm up once per worker instead of once per site. Returns each site's results, in order, with an 'error' if it failed
+def buildsites(rootdirs, options=[], jobs=None):
+    jobs = jobs or os.cpu_count()
+    sitejobs = [(rootdir, list(options)) for rootdir in rootdirs]
+    if jobs > 1 and len(sitejobs) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(min(jobs, len(sitejobs))) as pool:
+            return pool.map(buildworker, sitejobs, chunksize=1)
+    return [buildworker(sitejob) for sitejob in sitejobs]
+
+def buildworker(sitejob):
+    rootdir, options = sitejob
+    try:
+        return Texsite(rootdir, options).build()
+    except Exception as err:
+        # one broken site shouldn't stop the rest
+        return {'rootdir': rootdir, 'error': str(err)}
+
+# --watch serves the site from memory-warm rebuilds. Open pages get a small script that listens on /__texsite_reload and reloads after each build.
+# The server keeps the site directory, a generation number that is bumped after every rebuild, and a condition to wait on it with
+reloadscript = b'<script>new EventSource("/__texsite_reload").onmessage = function() { location.reload(); };</script>'
+
+class DevRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=args[2].sitedir, **kwargs)
+    def log_message(self, format, *args):
+        pass # keep the terminal for build messages
+
+    def do_GET(self):
+        if self.path == '/__texsite_reload':
+            self.sendreloads()
+            return
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as file:
+            content = file.read()
+        if path.endswith('.html'):
+            content = content.replace(b'</body>', reloadscript + b'</body>', 1)
+
+        # browsers revalidate with the etag, so unchanged files just get a 304
+        etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
+
+    # server-sent events: hold the connection open and send a message whenever a rebuild finishes
+    def sendreloads(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        with self.server.reloadcondition:
+            generation = self.server.generation
+        try:
+            while True:
+                with self.server.reloadcondition:
+                    self.server.reloadcondition.wait_for(lambda: self.server.generation != generation, timeout=15)
+                    newgeneration = self.server.generation
+                if newgeneration != generation:
+                    generation = newgeneration
+                    self.wfile.write(b'data: reload\n\n')
+                else:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the page was closed or reloaded
+
+# modification times and sizes of everything a build reads, so we can tell when something changed. Data files can be anywhere under the site
+# directory, so those are the ones the pages use (the keys of datahashes), None for one that isn't there (yet)
+def sitesignature(rootdir, dataFnames):
+    signature = dict()
+    for entry in os.scandir(os.path.join(os.getcwd(), rootdir)):
+        if entry.is_file() and (entry.name.endswith('.txt') or entry.name.endswith('.bib')):
+            signature[entry.path] = (entry.stat().st_mtime_ns, entry.stat().st_size)
+    for entry in os.scandir(os.path.join(os.getcwd(), rootdir, 'images')):
+        if entry.is_file():
+            signature[entry.path] = (entry.stat().st_mtime_ns, entry.stat().st_size)
+    for dataFname in dataFnames:
+        path = os.path.join(os.getcwd(), rootdir, dataFname)
+        signature[path] = (os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.isfile(path) else None
+    return signature
+
+# serve the site and rebuild whenever something changes. The build is incremental, so only the affected pages are rendered again
+def watchsite(site):
+    port = int(optionvalue(site.options, '--port', 8000))
+    server = http.server.ThreadingHTTPServer(('localhost', port), DevRequestHandler)
+    server.daemon_threads = True
+    server.sitedir = os.path.join(os.getcwd(), site.rootdir)
+    server.generation = 0
+    server.reloadcondition = threading.Condition()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Serving {} at http://localhost:{}/ and watching for changes. Press Ctrl-C to stop.'.format(site.rootdir, port))
+    signature = sitesignature(site.rootdir, site.datahashes.keys())
+    try:
+        while True:
+            time.sleep(0.1)
+            if sitesignature(site.rootdir, site.datahashes.keys()) == signature:
+                continue
+            time.sleep(0.05) # give the editor a moment to finish writing
+            signature = sitesignature(site.rootdir, site.datahashes.keys())
+            starttime = time.time()
+            try:
+                printresults(site.build(), site.options)
+            except Exception as err:
+                # half-typed pages are normal while watching, so report it and keep going
+                print('ERROR: {}'.format(err))
+                continue
+            finally:
+                # data files the pages started using in this build are watched from now on, as they were when it read them
+                for path, value in sitesignature(site.rootdir, site.datahashes.keys()).items():
+                    signature.setdefault(path, value)
+            print('Rebuilt in {:.2f} s'.format(time.time() - starttime))
+            with server.reloadcondition:
+                server.generation += 1
+                server.reloadcondition.notify_all()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+# print what build() returned, the way the command line always has
+# formulas that couldn't be converted, and where they are
+def printmatherrors(results):
+    for matherror in results.get('matherrors', []): # a --dry-run converts nothing
+        source = ' '.join(matherror['latex'].split())
+        print('WARNING: {}, line {}: could not convert {} ({}), its source is on the page in red instead'.format(matherror['file'], matherror['line'], source if len(source) <= 60 else source[:57] + '...', matherror['error']))
+
+def printresults(results, options):
+    if '--dry-run' in options:
+        for fname in results['reasons'].keys():
+            if results['reasons'][fname] != '':
+                print('{}: rebuild ({})'.format(fname, results['reasons'][fname]))
+            else:
+                print('{}: up to date'.format(fname))
+        return
+
+    print('Math cache: {} hits, {} misses'.format(results['mathcache']['hits'], results['mathcache']['misses']))
+    printmatherrors(results)
+    if results['export'] is not None:
+        print('Exported to {}: {} copied, {} unchanged, {} removed'.format(results['export']['directory'], results['export']['copied'], results['export']['unchanged'], results['export']['removed']))
+
+    # where the time went, for finding slow builds and for benchmarksite.py
+    if '--profile' in options:
+        with open(optionvalue(options, '--profile', 'profile.json'), 'w') as file:
+            json.dump(results, file, indent=1)
+        for phase in results['phases'].keys():
+            print('{:>24}: {:8.3f}s wall {:8.3f}s cpu'.format(phase, results['phases'][phase]['wall'], results['phases'][phase]['cpu']))
+
+# run one command line (anything but --serve) and print what happened
+def runcommand(argv):
+    if '--batch' in argv:
+        with open(optionvalue(argv, '--batch', '')) as file:
+            rootdirs = [line.strip() for line in file if line.strip() != '']
+        options = [option for option in argv[1:] if option != '--batch' and option != optionvalue(argv, '--batch', '')]
+        for results in buildsites(rootdirs, options, int(optionvalue(argv, '-j', 0))):
+            if 'error' in results:
+                print('{}: ERROR: {}'.format(results['rootdir'], results['error']))
+            else:
+                print('{}: {} of {} pages rendered in {:.2f} s'.format(results['rootdir'], len(results['rendered']), results['pages'], results['phases']['total']['wall']))
+                printmatherrors(results)
+        return
+
+    # --rollback only switches publichtml back to the generation before, see stagefile
+    if '--rollback' in argv:
+        try:
+            print('Rolled back {} to {}'.format(os.path.join(argv[1], 'publichtml'), rollbackgeneration(os.path.join(os.getcwd(), argv[1], 'publichtml'))))
+        except TexsiteError as err:
+            print('ERROR: {}'.format(err))
+        return
+
+    try:
+        site = Texsite(argv[1], argv[2:])
+    except TexsiteError as err:
+        print('ERROR: {}'.format(err))
+        return
+    try:
+        printresults(site.build(), site.options)
+    except TexsiteError as err:
+        print('ERROR: {}'.format(err))
+        if '--watch' not in argv:
+            return
+
+    if '--watch' in argv:
+        watchsite(site)
+
+# the daemon listens on a unix socket, one per user unless --socket says otherwise
+def defaultsocket():
+    runtimedir = os.environ.get('XDG_RUNTIME_DIR', '')
+    if runtimedir == '' or not os.path.isdir(runtimedir):
+        # a directory only this user can get into, so nobody else can put a socket where we look for one
+        runtimedir = os.path.join(tempfile.gettempdir(), 'texsite-{}'.format(getattr(os, 'getuid', lambda: 0)()))
+        try:
+            os.mkdir(runtimedir, 0o700)
+        except FileExistsError:
+            pass # ownedsocket checks whose it is
+    return os.path.join(runtimedir, 'texsite.sock')
+
+# whether socketpath (or where it would go, for the daemon) is ours: our socket, in a directory nobody else can swap it out of, one that is
+# ours (or root's) and only writable by its owner, or sticky like /tmp. Checked before any command line is sent to it
+def ownedsocket(socketpath, exists=True):
+    uid = getattr(os, 'getuid', lambda: 0)()
+    try:
+        dirstat = os.stat(os.path.dirname(os.path.abspath(socketpath)))
+        if dirstat.st_uid not in [uid, 0] or (dirstat.st_mode & 0o022 != 0 and dirstat.st_mode & stat.S_ISVTX == 0):
+            return False
+        if not exists:
+            return True
+        socketstat = os.lstat(socketpath)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(socketstat.st_mode) and socketstat.st_uid == uid
+
+# --serve keeps one process running with everything imported and the caches warm, and runs the command lines clients send it.
+# Commands are run one at a time, in the client's working directory, and whatever they print is sent back to the client as it is printed
+def servedaemon(socketpath):
+    if not hasattr(socket, 'AF_UNIX'):
+        print('ERROR: --serve needs unix sockets, which this system does not have.')
+        return
+    if forwardtodaemon(socketpath, None):
+        print('ERROR: a daemon is already serving on {}.'.format(socketpath))
+        return
+    if not ownedsocket(socketpath, False) or (os.path.lexists(socketpath) and not ownedsocket(socketpath)):
+        print('ERROR: {} is somewhere other users can get at it, pick another --socket.'.format(socketpath))
+        return
+    if os.path.lexists(socketpath):
+        os.remove(socketpath) # left over from a daemon that didn't shut down cleanly
+
+    # pay for the slow imports now, instead of on the first build
+    import latex2mathml.converter
+    import pybtex.database
+    import pybtex.plugin
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketpath)
+    os.chmod(socketpath, 0o600)
+    server.listen()
+    print('Serving builds on {}. Press Ctrl-C to stop.'.format(socketpath))
+    scriptstamp = os.stat(__file__).st_mtime_ns
+    homedir = os.getcwd()
+    try:
+        while True:
+            connection, address = server.accept()
+            with connection, connection.makefile('r') as requests, connection.makefile('w', buffering=1) as replies:
+                try:
+                    request = json.loads(requests.readline())
+                    # a client running newer code than we loaded has to build for itself
+                    if request['argv'] is None or request['script'] != scriptstamp:
+                        replies.write('stale\n' if request['argv'] is not None else 'ok\n')
+                        continue
+                    replies.write('ok\n')
+                    os.chdir(request['cwd'])
+                    with contextlib.redirect_stdout(replies):
+                        try:
+                            runcommand(request['argv'])
+                        except Exception:
+                            traceback.print_exc(file=replies)
+                except (OSError, ValueError, KeyError):
+                    pass # the client went away, or didn't send a proper request
+                finally:
+                    os.chdir(homedir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socketpath)
+
+# send a command line to the daemon and print what it sends back. Returns False if no daemon is running (or it is running older code),
+# and the caller should build in this process instead. With argv None, this only checks whether a daemon is there
+def forwardtodaemon(socketpath, argv):
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    if not ownedsocket(socketpath):
+        return False
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socketpath)
+        # and where the system can say, that it is our own process on the other end
+        if hasattr(socket, 'SO_PEERCRED') and struct.unpack('3i', client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))[1] != os.getuid():
+            client.close()
+            return False
+    except OSError:
+        return False
+    with client, client.makefile('r') as replies:
+        client.sendall((json.dumps({'cwd': os.getcwd(), 'argv': argv, 'script': os.stat(__file__).st_mtime_ns}) + '\n').encode('utf-8'))
+        if replies.readline().strip() != 'ok':
+            return False
+        for line in replies:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    return True
+
+# the command line. Everything above can be imported and used without it
+def main():
+    if '--math-worker' in sys.argv:
+        runmathworker(int(optionvalue(sys.argv, '--math-worker', 0)))
+        return
+
+    # Print usage.
+    if len(sys.argv) == 1 or '-h' in sys.argv:
+        print("Usage: compilesite.py <directory> [options]")
+        print("       compilesite.py --batch FILE [options]")
+        print()
+        print("Compiles the given directory into a teXsite. Options must be after the directory. Try using texsiteinit.py for creating your first directory to see the required files.")
+        print()
+        print("Options:")
+        print("-h: Show this (h)elp menu.")
+        print("--batch FILE: Build every site directory listed in FILE (one per line), several at a time in one process. -j N sets how many at once.")
+        print("--serve: Run as a daemon that keeps everything imported and cached, and builds whatever later runs of compilesite.py ask for. Those runs use it automatically.")
+        print("--no-daemon: Build in this process, even if a daemon is running.")
+        print("--socket PATH: Unix socket for the daemon (default texsite.sock in $XDG_RUNTIME_DIR, or in a texsite-<uid> directory only you can read in the temp directory).")
+        print("-e: Put compile files in publichtml directory for easy (e)xporting.")
+        print("--atomic: With -e, put each export together in a new directory in publichtml-generations and then switch publichtml (a symlink) over to it at once, so a server serving publichtml never shows a half-written site. Unchanged files are hardlinked from the generation before, which is kept.")
+        print("--rollback: Switch publichtml back to the generation before, after -e --atomic.")
+        print("-v: Print the (v)ersion number.")
+        print("-f: (F)orce a full rebuild, ignoring the build manifest.")
+        print("--dry-run: Print which pages would be rebuilt and why, without writing anything.")
+        print("-j N: Render N pages at a time in parallel (0 uses every core).")
+        print("--watch: Keep running, rebuild whenever a page, bib file, index.txt or image changes, and serve the site with live reload.")
+        print("--port N: Port for --watch to serve the site on (default 8000).")
+        print("--minify: Minify the html and css that gets written.")
+        print("--search: Also write a search page, search.html, and an index of every word on the site for it, split into small files in search/ so the browser only loads what it needs.")
+        print("--compress: Also write .gz (and .zst, if zstandard is installed) copies of every html and css file, for servers that can send precompressed files.")
+        print("--math-cache-size N: Keep at most N formulas in the math cache (default 50000, 0 turns it off).")
+        print("--math-timeout S: Give up on a formula that latex2mathml takes more than S seconds on, and show its source in red instead (default 10). 0 converts in this process, with no limit.")
+        print("--math-workers N: How many processes convert math for each process rendering pages (default: the cores left over after -j, from 2 to 4).")
+        print("--math-memory MB: Memory the process converting math may use, where the system can limit it (default 1024, 0 for no limit).")
+        print("--page PAGE: Only render PAGE (like firstpage.txt) and the table of contents, looking up what it refers to in the label index from the last full build. -e is ignored.")
+        print("--toc-chapters: Only list the chapters on index.html, and load the sections of a chapter from toc/ when it is opened, for sites with a lot of sections.")
+        print("--defer-math N: Keep the first N characters of each page as they are, and below that, only put a section's math on the page when it is scrolled near (try 1500, about a screen). A page with a line \\nodefermath keeps all its math.")
+        print("--split-above N: Pages whose source is bigger than N KB are written as one html file for each \\section, with its own bibliography of what it cites (off by default, 0 splits every page).")
+        print("--fingerprint: Put the content hash in the names of style.css and every image, so they can be cached forever, and write _headers with the cache headers for every published file (for Netlify, Cloudflare Pages and the like).")
+        print("--stream-above N: Pages bigger than N MB are read and written a piece at a time instead of all at once, so memory stays flat however big they are (default 64, 0 streams every page).")
+        print("--profile FILE: Write the wall and cpu time of each phase of the build, and counters for each page rendered, to FILE as json.")
+        print("--profile-page PAGE: With --profile, also run PAGE (like firstpage.txt) under cProfile and save the stats next to FILE, with a .prof extension.")
+        exit()
+
+    if '-v' in sys.argv:
+        print("teXsite compiler, version {}".format(versionnumber))
+        exit()
+
+    socketpath = optionvalue(sys.argv, '--socket', defaultsocket())
+    if '--serve' in sys.argv:
+        servedaemon(socketpath)
+        return
+
+    # hand the command to the daemon if one is running, since it has everything imported and warmed up already
+    if '--watch' not in sys.argv and '--no-daemon' not in sys.argv and forwardtodaemon(socketpath, sys.argv):
+        return
+
+    runcommand(sys.argv)
+
+if __name__ == '__main__':
+    main()
 
 # TODO: could further make a script that converts a latex project into a texsite one. That seems like it would be nice. Just put the labels in the right place, change the figures to the right format, do inline math to $$ not $, change aligns to separate equations, tables as well.
 
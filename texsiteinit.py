@@ -8,6 +8,13 @@ import os
 import json
 from pathlib import Path
 import shutil
+import random
+
+# grab the value given after an option like --pages 100, or the default if it isn't there
+def optionvalue(option, default):
+    if option in sys.argv and sys.argv.index(option) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(option) + 1]
+    return default
 
 # Print usage
 if len(sys.argv) == 1 or '-h' in sys.argv:
@@ -18,6 +25,9 @@ if len(sys.argv) == 1 or '-h' in sys.argv:
     print("Options:")
     print("-h: Show this (h)elp menu.")
     print("-v: Print the (v)ersion number.")
+    print("--synthetic: Make a large generated site instead of the example, for benchmarking compilesite.py. The counts below are per page:")
+    print("    --pages N (default 10), --sections N (5), --equations N (20), --inline N (100 inline formulas), --tables N (3),")
+    print("    --figures N (3), --refs N (20 references to other pages), --cites N (10), --bibentries N (200 entries in refs.bib), --seed N (0)")
     exit()
 
 versionnumber = '0.0.3'
@@ -43,6 +53,91 @@ Path(imagesdir).mkdir(parents=True, exist_ok=True)
 # cp example image to that subdirectory
 shutil.copy('example.png', imagesdir)
 
+# with --synthetic, write a generated site of whatever size is asked for, so we can measure how compilesite.py scales. Same seed, same site
+if '--synthetic' in sys.argv:
+    numpages = int(optionvalue('--pages', 10))
+    numsections = max(1, int(optionvalue('--sections', 5)))
+    numequations = int(optionvalue('--equations', 20))
+    numinline = int(optionvalue('--inline', 100))
+    numtables = int(optionvalue('--tables', 3))
+    numfigures = int(optionvalue('--figures', 3))
+    numrefs = int(optionvalue('--refs', 20))
+    numcites = int(optionvalue('--cites', 10))
+    numbibentries = max(1, int(optionvalue('--bibentries', 200)))
+    rng = random.Random(int(optionvalue('--seed', 0)))
+
+    # formulas repeat across pages like they do on real sites, with some variety from the index
+    inlineformulas = ['k_{{{k}}}', 'x^{{{k}}}', 'A_{{{k}}}', '\\alpha_{{{k}}} + \\beta', '\\frac{{a_{{{k}}}}}{{b}}', '\\sum_{{i=1}}^{{{k}}} i^2', 'e^{{i \\theta_{{{k}}}}}', 'B_{{n}} = {k}']
+    equationformulas = ['\\int_0^{{{k}}} dx \\; x^2 = \\frac{{{k}^3}}{{3}} \\; .', 'E_{{{k}}} = m c^2 \\; .', '\\frac{{d}}{{dt}} p_{{{k}}} = - \\gamma p_{{{k}}} + \\sum_j W_{{{k} j}} p_j \\; .']
+    def inlinemath():
+        return '$$' + rng.choice(inlineformulas).format(k=rng.randint(1, 30)) + '$$'
+
+    # references go to equations and sections on other pages
+    def reftarget(page):
+        otherpage = rng.choice([pp for pp in range(1, numpages + 1) if pp != page] or [page])
+        if numequations > 0 and rng.random() < 0.7:
+            return 'eq:p{}-{}'.format(otherpage, rng.randint(1, numequations))
+        return 'sec:p{}-{}'.format(otherpage, rng.randint(1, numsections))
+
+    toctxt = '\\title{Synthetic teXsite}\n'
+    toctxt += '\\author{texsiteinit.py}\n\n'
+    toctxt += 'A generated site with {} pages for benchmarking.\n\n'.format(numpages)
+    for page in range(1, numpages + 1):
+        toctxt += '\\include{{page{}.txt}}{{{}}}{{Page {}}}\n'.format(page, page, page)
+    with open(os.path.join(os.getcwd(), rootdir, 'index.txt'), 'w') as file:
+        file.write(toctxt)
+
+    for page in range(1, numpages + 1):
+        # deal the items out to the sections round robin
+        sectionblocks = [[] for section in range(numsections)]
+        paragraphs = [[] for section in range(numsections)]
+        for ii in range(numinline):
+            paragraphs[ii % numsections].append('Some text around the formula ' + inlinemath() + ' and more text after it.')
+        for ii in range(numrefs):
+            paragraphs[ii % numsections].append('As shown in \\ref{' + reftarget(page) + '}, this follows.')
+        for ii in range(numcites):
+            keys = ['entry{}'.format(rng.randint(1, numbibentries)) for kk in range(rng.randint(1, 3))]
+            paragraphs[ii % numsections].append('This was studied before \\cite{' + ', '.join(keys) + '}.')
+        for section in range(numsections):
+            rng.shuffle(paragraphs[section])
+            # five sentences to a paragraph
+            for ii in range(0, len(paragraphs[section]), 5):
+                sectionblocks[section].append(' '.join(paragraphs[section][ii:ii+5]) + '\n')
+        for ii in range(numequations):
+            sectionblocks[ii % numsections].append('\\begin{equation}{eq:p' + str(page) + '-' + str(ii + 1) + '}\n  ' + rng.choice(equationformulas).format(k=rng.randint(1, 30)) + '\n\\end{equation}\n')
+        for ii in range(numtables):
+            tabletxt = '\\begin{table}{tab:p' + str(page) + '-' + str(ii + 1) + '}\n'
+            tabletxt += ' & ' + ' & '.join([inlinemath() for column in range(5)]) + '\n'
+            for row in range(8):
+                tabletxt += inlinemath() + ' & ' + ' & '.join([str(rng.randint(0, 99)) for column in range(5)]) + '\n'
+            tabletxt += '\\caption{A generated table, with math like ' + inlinemath() + ' and a reference to \\ref{' + reftarget(page) + '}.}\n\\end{table}\n'
+            sectionblocks[ii % numsections].append(tabletxt)
+        for ii in range(numfigures):
+            sectionblocks[ii % numsections].append('\\begin{figure}{fig:p' + str(page) + '-' + str(ii + 1) + '}\n  \\includegraphics{example.png}{0.5}\n  \\caption{A generated figure of ' + inlinemath() + '.}\n\\end{figure}\n')
+
+        pagetxt = ''
+        for section in range(numsections):
+            pagetxt += '\\section{Section ' + str(section + 1) + '}{sec:p' + str(page) + '-' + str(section + 1) + '}\n\n'
+            pagetxt += '\n'.join(sectionblocks[section]) + '\n'
+        if numcites > 0:
+            pagetxt += '\\bibliography{refs.bib}{unsrt}\n'
+        with open(os.path.join(os.getcwd(), rootdir, 'page{}.txt'.format(page)), 'w') as file:
+            file.write(pagetxt)
+
+    bibtxt = ''
+    for entry in range(1, numbibentries + 1):
+        bibtxt += '@article{entry' + str(entry) + ',\n'
+        bibtxt += '  title={Generated article number ' + str(entry) + '},\n'
+        bibtxt += '  author={Author, First and Writer, Second},\n'
+        bibtxt += '  journal={Journal of Synthetic Results},\n'
+        bibtxt += '  volume={' + str(entry % 40 + 1) + '},\n'
+        bibtxt += '  pages={' + str(entry) + '--' + str(entry + 9) + '},\n'
+        bibtxt += '  year={' + str(1990 + entry % 35) + '}\n'
+        bibtxt += '}\n\n'
+    with open(os.path.join(os.getcwd(), rootdir, 'refs.bib'), 'w') as file:
+        file.write(bibtxt)
+    exit()
+
 # make index.txt with some boilerplate
 
 tocFname = os.path.join(os.getcwd(), rootdir, 'index.txt')